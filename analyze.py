@@ -1,89 +1,563 @@
+import hashlib
+import io
+import json
 import os
 import chess.pgn
+import chess.polyglot
 import chess
 from collections import defaultdict
 import pickle
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
 import numpy as np
 
+from settings import SETTINGS
+from split_pgn import PgnContainer, clean_player_name, is_container
+from stats_table import STATS_DTYPE, TABLE_EXT, save_table
+from telemetry import get_telemetry
 
-def analyze_dir(directory, out_dir, batch_size=1000):
+COUNTS_EXT = '.counts.npy'
+INGESTED_FILE = 'ingested.json'
+COMMIT_FILE = 'commit.json'
+PENDING_EXT = '.pending'
+MAX_PLIES = 50
+
+
+def analyze_dir(directory, out_dir, batch_size=1000, workers=None, use_processes=True, chunksize=16,
+                remove_inputs=True, skip=(), on_done=None):
+    # Files named in skip are left out, on_done(file_name) is called for every analyzed file.
+    # With remove_inputs=False the split files are kept, e.g. until later stages have finished.
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
+    telemetry = get_telemetry()
+
+    if is_container(directory):
+        analyze_container(directory, out_dir, workers, chunksize, skip, on_done)
+        return
 
+    skip = set(skip)
     file_paths = [
         os.path.join(directory, file_name)
         for file_name in os.listdir(directory)
-        if os.path.isfile(os.path.join(directory, file_name))
+        if os.path.isfile(os.path.join(directory, file_name)) and file_name not in skip
     ]
+    telemetry.progress(len(file_paths))
+
+    if use_processes:
+        # Parsing is CPU bound, so threads stay on one core. Workers write their own table
+        # and only send back the file name, an error message and their timing.
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for i in range(0, len(file_paths), batch_size):
+                batch = file_paths[i:i + batch_size]
+                tasks = executor.map(analyze_file_task, batch, repeat(out_dir), repeat(remove_inputs),
+                                     chunksize=chunksize)
+                for result in tasks:
+                    record_file(telemetry, *result, on_done=on_done)
+        return
 
     # Process files in batches
     for i in range(0, len(file_paths), batch_size):
         batch = file_paths[i:i + batch_size]
 
-        with ThreadPoolExecutor() as executor:
-            futures = {executor.submit(analyze_file, file_path, out_dir): file_path for file_path in batch}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(analyze_file_task, file_path, out_dir, remove_inputs) for file_path in batch]
             for future in as_completed(futures):
-                file_path = futures[future]
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error processing {file_path}: {e}")
+                record_file(telemetry, *future.result(), on_done=on_done)
+
+
+def record_file(telemetry, file_path, error, seconds, games, on_done=None):
+    telemetry.advance()
+    if error is not None:
+        telemetry.error(file_path, error)
+        return
+    telemetry.count('games', games)
+    telemetry.observe('file_seconds', seconds, file_path)
+    telemetry.observe('games_per_file', games, file_path)
+    if on_done is not None:
+        on_done(os.path.basename(file_path))
+
+
+def analyze_file_task(file_path, out_dir, remove_input=True):
+    start = time.perf_counter()
+    try:
+        games = analyze_file(file_path, out_dir, remove_input)
+    except Exception as e:
+        return file_path, str(e), time.perf_counter() - start, 0
+    return file_path, None, time.perf_counter() - start, games
+
+
+def analyze_container(directory, out_dir, workers=None, chunksize=16, skip=(), on_done=None):
+    # Split written by split_pgn(container=True), the container is kept
+    skip = set(skip)
+    keys = [file_key for file_key in PgnContainer(directory).keys if file_key not in skip]
+    telemetry = get_telemetry()
+    telemetry.progress(len(keys))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(analyze_container_task, repeat(directory), keys, repeat(out_dir),
+                                   chunksize=chunksize):
+            record_file(telemetry, *result, on_done=on_done)
+
+
+_containers = {}
 
 
-def analyze_file(filename, out_dir):
+def analyze_container_task(directory, file_key, out_dir):
+    start = time.perf_counter()
+    # progress is called once per game read
+    games = []
+    try:
+        if not os.path.exists(f"{out_dir}/{file_key}{TABLE_EXT}"):
+            # Opened once per worker process
+            if directory not in _containers:
+                _containers[directory] = PgnContainer(directory)
+            color = file_key.split("_")[-1]
+            pgn = _containers[directory].read(file_key).decode('utf-8', 'replace')
+            table = analyze_games([pgn], None if color == "none" else color, progress=games.append)
+            save_table(table, f"{out_dir}/{file_key}{TABLE_EXT}")
+    except Exception as e:
+        return file_key, str(e), time.perf_counter() - start, 0
+    return file_key, None, time.perf_counter() - start, len(games)
+
+
+def analyze_file(filename, out_dir, remove_input=True):
     file_name_without_ext = os.path.splitext(os.path.basename(filename))[0]
     color = file_name_without_ext.split("_")[-1]
 
-    if os.path.exists(f"{out_dir}/{file_name_without_ext}.pkl"):
+    if os.path.exists(f"{out_dir}/{file_name_without_ext}{TABLE_EXT}"):
+        if remove_input:
+            os.remove(filename)
+        return 0
+
+    # Returns the number of games read, progress is called once per game
+    games = []
+    results = process_pgn(filename, None if color == "none" else color, progress=games.append)
+    save_table(results, f"{out_dir}/{file_name_without_ext}{TABLE_EXT}")
+    if remove_input:
         os.remove(filename)
-        return True
+    return len(games)
+
+
+def new_games_data():
+    # (position, year, move) -> [games, points], in the order the entries were first counted
+    return {}
+
 
-    results = process_pgn(filename, None if color == "none" else color)
+def add_count(games_data, key, games, points):
+    counts = games_data.get(key)
+    if counts is None:
+        games_data[key] = [games, points]
+    else:
+        counts[0] += games
+        counts[1] += points
 
-    # Convert the defaultdict to a regular dict before pickling
-    results_dict = {fen: dict(year_data) for fen, year_data in results.items()}
-    for fen in results_dict:
-        results_dict[fen] = {move: list(data) for move, data in results_dict[fen].items()}
 
-    with open(f"{out_dir}/{file_name_without_ext}.pkl", 'wb') as out:
-        pickle.dump(results_dict, out)
-    os.remove(filename)
-    return True
+def color_targets(games_data, color):
+    # Counts of the side to move, indexed by board.turn (black, white)
+    return (games_data if color in (None, "black") else None,
+            games_data if color in (None, "white") else None)
 
 
-def process_pgn(file_path, color=None):
-    games_data = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: {"games": 0, "points": 0})))
-    years = []
+def process_pgn(file_path, color=None, fens=None, progress=None):
+    games_data = new_games_data()
+    counter = PlyCounter(lambda headers: color_targets(games_data, color), fens)
 
+    count = 0
     with open(file_path, "r") as pgn_file:
-        while (game := chess.pgn.read_game(pgn_file)) is not None:
-            year = game.headers.get("Date", 'Unknown')[:4]
-            if year.isdigit():
-                int_year = int(year)
-                years.append(int_year)
-                board = game.board()
-                result = game.headers.get("Result")
-
-                try:
-                    for i, move in enumerate(game.mainline_moves()):
-                        if i >= 50:
-                            break
-                        fen = " ".join(board.fen().split(" ")[:-2])
-                        if board.is_legal(move):
-                            if (color == "white" and board.turn == chess.WHITE) or \
-                                    (color == "black" and board.turn == chess.BLACK) or \
-                                    color is None:
-                                games_data[fen][int_year][move.uci()]["games"] += 1
-                                games_data[fen][int_year][move.uci()]["points"] += get_points(result, board.turn)
-                            board.push(move)
-                        else:
+        while chess.pgn.read_game(pgn_file, Visitor=lambda: counter) is not None:
+            count += 1
+            if progress is not None:
+                progress(count)
+
+    return aggregate_table(games_data)
+
+
+def analyze_games(games, color=None, progress=None, fens=None):
+    # In-memory counterpart of analyze_file: games are chess.pgn.Game objects or PGN strings
+    # (one or more games each), the statistics table is returned instead of written
+    games_data = new_games_data()
+    counter = PlyCounter(lambda headers: color_targets(games_data, color), fens)
+    count = 0
+    for item in games:
+        if isinstance(item, chess.pgn.Game):
+            process_game(item, color, games_data, [], fens)
+            count += 1
+            if progress is not None:
+                progress(count)
+            continue
+        pgn = io.StringIO(item)
+        while chess.pgn.read_game(pgn, Visitor=lambda: counter) is not None:
+            count += 1
+            if progress is not None:
+                progress(count)
+    return aggregate_table(games_data)
+
+
+class PlyCounter(chess.pgn.BaseVisitor):
+    # Visitor for chess.pgn.read_game that counts the first MAX_PLIES mainline moves straight into
+    # flat counts, without building the game tree. Games without a year or without a counted side
+    # are skipped by the parser after their headers, variations and moves past the limit are not parsed.
+    def __init__(self, get_targets, fens=None):
+        # get_targets(headers) returns counts of the side to move, see color_targets
+        self.get_targets = get_targets
+        self.fens = fens
+        self.hasher = PositionHasher()
+
+    def begin_game(self):
+        self.hasher.reset()
+        self.headers = {}
+        self.targets = None
+        self.plies = 0
+        self.counted = 0
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def end_headers(self):
+        year = self.headers.get("Date", 'Unknown')[:4]
+        if not year.isdigit():
+            return chess.pgn.SKIP
+        self.targets = self.get_targets(self.headers)
+        if self.targets[chess.WHITE] is None and self.targets[chess.BLACK] is None and self.fens is None:
+            return chess.pgn.SKIP
+
+        self.year = int(year)
+        result = self.headers.get("Result")
+        self.points = (get_points(result, chess.BLACK), get_points(result, chess.WHITE))
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def begin_parse_san(self, board, san):
+        if self.plies >= MAX_PLIES:
+            return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        # board is the position before the move, hashed only if the side to move is counted
+        games_data = self.targets[board.turn]
+        if games_data is not None or self.fens is not None:
+            position = self.hasher(board)
+            if self.fens is not None and position not in self.fens:
+                self.fens[position] = position_fen(board)
+        if not move:
+            # Null moves end the game, as they are not legal moves in process_game
+            self.plies = MAX_PLIES
+            return
+        self.plies += 1
+
+        if games_data is not None:
+            add_count(games_data, (position, self.year, move.uci()), 1, self.points[board.turn])
+            self.counted += 1
+
+    def handle_error(self, error):
+        # The parser skips the rest of the mainline after an illegal move, like GameBuilder does
+        pass
+
+    def result(self):
+        return self.counted
+
+
+def process_game(game, color, games_data, years, fens=None):
+    year = game.headers.get("Date", 'Unknown')[:4]
+    if not year.isdigit():
+        return 0
+
+    int_year = int(year)
+    years.append(int_year)
+    board = game.board()
+    result = game.headers.get("Result")
+    targets = color_targets(games_data, color)
+    counted = 0
+
+    try:
+        for i, move in enumerate(game.mainline_moves()):
+            if i >= MAX_PLIES:
+                break
+            position = position_key(board)
+            if fens is not None and position not in fens:
+                fens[position] = position_fen(board)
+            # Mainline moves were validated by the parser, only null moves are not legal
+            if not move:
+                break
+            if targets[board.turn] is not None:
+                add_count(games_data, (position, int_year, move.uci()), 1, get_points(result, board.turn))
+                counted += 1
+            board.push(move)
+    except Exception as e:
+        print(f"Error processing move: {e}")
+
+    return counted
+
+
+def analyze_pgn(pgn_file, out_dir, max_pending_plies=20_000_000, spill_dir=None, incremental=False, state_dir=None):
+    # Single pass over the master pgn, equivalent to split_pgn followed by analyze_dir.
+    # Raw counts of every player are kept in state_dir, so with incremental=True only games
+    # added to pgn_file since the last run are parsed and merged into them. A table without counts
+    # is rebuilt from the files in ingested.json first, so it is never replaced by the new games alone.
+    # Returns the number of games parsed.
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    state_dir = state_dir or SETTINGS['analysis_state_dir']
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+
+    remove_spill_dir = spill_dir is None
+    if spill_dir is None:
+        spill_dir = tempfile.mkdtemp(prefix="spill_", dir=out_dir)
+    elif not os.path.exists(spill_dir):
+        os.makedirs(spill_dir)
+
+    # Finishes the save of a run that crashed after its commit point
+    apply_commit(state_dir)
+    ingested = load_ingested(state_dir)
+    start_offset = ingested_offset(pgn_file, ingested) if incremental else 0
+    missing_counts = set()
+    if incremental:
+        missing_counts = {name[:-len(TABLE_EXT)] for name in os.listdir(out_dir) if name.endswith(TABLE_EXT)
+                          and not os.path.exists(os.path.join(state_dir, name[:-len(TABLE_EXT)] + COUNTS_EXT))}
+    telemetry = get_telemetry()
+    telemetry.progress(os.path.getsize(pgn_file) - start_offset, 'bytes')
+
+    ignored_players = set(SETTINGS['ignored_players'])
+    aggregators = {}
+    done = set()
+    spilled = set()
+    pending_plies = 0
+
+    def get_aggregator(file_key):
+        nonlocal pending_plies
+        if file_key in done:
+            return None
+        if file_key not in aggregators:
+            games_data = new_games_data()
+            if incremental:
+                counts_path = os.path.join(state_dir, f"{file_key}{COUNTS_EXT}")
+                if os.path.exists(counts_path):
+                    pending_plies += load_counts(counts_path, games_data)
+            elif os.path.exists(f"{out_dir}/{file_key}{TABLE_EXT}"):
+                done.add(file_key)
+                return None
+            aggregators[file_key] = games_data
+        return aggregators[file_key]
+
+    def get_targets(headers, only=None):
+        targets = []
+        for player, color in ((clean_player_name(headers.get('Black', '?')), 'black'),
+                              (clean_player_name(headers.get('White', '?')), 'white')):
+            file_key = f"{player}_{color}"
+            skipped = player in ignored_players or (only is not None and file_key not in only)
+            targets.append(None if skipped else get_aggregator(file_key))
+        return targets
+
+    def spill():
+        telemetry.count('spills')
+        telemetry.event('spill', players=len(aggregators))
+        for file_key, games_data in aggregators.items():
+            if games_data:
+                with open(os.path.join(spill_dir, f"{file_key}.spill"), 'ab') as spill_file:
+                    pickle.dump(games_data, spill_file)
+                games_data.clear()
+                spilled.add(file_key)
+
+    def add_plies(counted):
+        nonlocal pending_plies
+        pending_plies += counted
+        if pending_plies >= max_pending_plies:
+            spill()
+            pending_plies = 0
+
+    try:
+        if missing_counts:
+            # Counts of these tables are rebuilt from the part of every ingested file they were made of
+            telemetry.event('rebuild_counts', tables=len(missing_counts))
+            counter = PlyCounter(lambda headers: get_targets(headers, missing_counts))
+            for source in ingested:
+                end_offset = start_offset if source == os.path.abspath(pgn_file) else ingested_offset(source, ingested)
+                with open(source, 'rb') as raw_source:
+                    lines = BoundedLines(raw_source, end_offset)
+                    while (counted := chess.pgn.read_game(lines, Visitor=lambda: counter)) is not None:
+                        add_plies(counted)
+            telemetry.count('rebuilt_counts', len(missing_counts & (aggregators.keys() | spilled)))
+
+        with open(pgn_file, 'rb') as raw_pgn:
+            raw_pgn.seek(start_offset)
+            pgn = io.TextIOWrapper(raw_pgn)
+            # Both players' plies are counted in one walk over the game
+            counter = PlyCounter(get_targets)
+            games = 0
+            while (counted := chess.pgn.read_game(pgn, Visitor=lambda: counter)) is not None:
+                games += 1
+                if games % 1000 == 0:
+                    telemetry.count('games', 1000)
+                    # Position of the buffered reader, ahead of the parser by at most one buffer
+                    telemetry.advance(done=raw_pgn.tell() - start_offset)
+                add_plies(counted)
+            # read_game stops only at the end of the file
+            end_offset = raw_pgn.tell()
+            pgn.detach()
+            telemetry.count('games', games % 1000)
+            telemetry.advance(done=end_offset - start_offset)
+
+        # Counts and tables are saved under pending names and renamed only after ingested.json records
+        # the new offset, so a crash never leaves counts that the next run would add the same games to
+        renames = []
+        for file_key, games_data in aggregators.items():
+            if file_key in spilled:
+                merged = new_games_data()
+                with open(os.path.join(spill_dir, f"{file_key}.spill"), 'rb') as spill_file:
+                    while True:
+                        try:
+                            merge_games_data(merged, pickle.load(spill_file))
+                        except EOFError:
                             break
-                except Exception as e:
-                    print(f"Error processing move: {e}")
-                    continue
+                merge_games_data(merged, games_data)
+                games_data = merged
+
+            with telemetry.timer('save_seconds', file_key):
+                counts_path = os.path.join(state_dir, f"{file_key}{COUNTS_EXT}")
+                table_path = f"{out_dir}/{file_key}{TABLE_EXT}"
+                save_counts(games_data, counts_path + PENDING_EXT)
+                save_table(aggregate_table(games_data), table_path + PENDING_EXT)
+                renames += [[counts_path + PENDING_EXT, counts_path], [table_path + PENDING_EXT, table_path]]
+            telemetry.count('files')
+
+        ingested[os.path.abspath(pgn_file)] = {'offset': end_offset, 'sha1': file_sha1(pgn_file, end_offset)}
+        # Commit point: from here a crashed run is finished by apply_commit on the next one
+        path = os.path.join(state_dir, COMMIT_FILE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'ingested': ingested, 'renames': renames}, file)
+        os.replace(path + '.tmp', path)
+        apply_commit(state_dir)
+        return games
+    finally:
+        if remove_spill_dir:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def load_ingested(state_dir):
+    path = os.path.join(state_dir, INGESTED_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_ingested(state_dir, ingested):
+    path = os.path.join(state_dir, INGESTED_FILE)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(ingested, file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def apply_commit(state_dir):
+    # Safe to repeat, files renamed before a crash are not pending anymore
+    path = os.path.join(state_dir, COMMIT_FILE)
+    if not os.path.exists(path):
+        return
+    with open(path) as file:
+        commit = json.load(file)
+    save_ingested(state_dir, commit['ingested'])
+    for pending_path, final_path in commit['renames']:
+        if os.path.exists(pending_path):
+            os.replace(pending_path, final_path)
+    os.remove(path)
+
+
+class BoundedLines:
+    # Lines of a binary file up to end, for chess.pgn.read_game which only calls readline
+    def __init__(self, raw, end):
+        self.raw = raw
+        self.end = end
+
+    def readline(self):
+        if self.raw.tell() >= self.end:
+            return ''
+        return self.raw.readline().decode('utf-8')
+
+
+def ingested_offset(pgn_file, ingested):
+    entry = ingested.get(os.path.abspath(pgn_file))
+    if entry is None:
+        return 0
+    if os.path.getsize(pgn_file) < entry['offset'] or file_sha1(pgn_file, entry['offset']) != entry['sha1']:
+        raise ValueError(f"{pgn_file} changed since it was analyzed, only appended games can be added incrementally")
+    return entry['offset']
+
+
+def file_sha1(path, length, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        while length > 0:
+            block = file.read(min(block_size, length))
+            if not block:
+                break
+            sha1.update(block)
+            length -= len(block)
+    return sha1.hexdigest()
+
+
+def save_counts(games_data, path):
+    with open(path, 'wb') as file:
+        np.save(file, raw_counts(games_data), allow_pickle=False)
+
+
+def load_counts(path, games_data):
+    raw = np.load(path, allow_pickle=False)
+    for position, year, move, games, points in zip(raw['position'].tolist(), raw['year'].tolist(),
+                                                    raw['move'].tolist(), raw['games'].tolist(),
+                                                    raw['points'].tolist()):
+        add_count(games_data, (position, year, move.decode()), games, points)
+    return len(raw)
 
-    return calculate_percentage_and_points(games_data, years)
+
+def merge_games_data(games_data, partial):
+    # Partials are merged in the order they were produced, keeping the first-seen key order
+    for key, (games, points) in partial.items():
+        add_count(games_data, key, games, points)
+
+
+def position_key(board):
+    # Polyglot hash covers pieces, side to move, castling and en passant, but not the move counters
+    return chess.polyglot.zobrist_hash(board)
+
+
+ZOBRIST_ARRAY = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+ZOBRIST_HASHER = chess.polyglot.ZobristHasher(ZOBRIST_ARRAY)
+
+
+class PositionHasher:
+    # position_key of successive positions of one game: the piece part of the hash is updated only for
+    # squares that changed since the previous call, instead of hashing every piece again
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.masks = (0,) * 12
+        self.piece_hash = 0
+
+    def __call__(self, board):
+        # Squares of every piece kind in polyglot order, (piece_type - 1) * 2 + color
+        black, white = board.occupied_co
+        masks = (board.pawns & black, board.pawns & white, board.knights & black, board.knights & white,
+                 board.bishops & black, board.bishops & white, board.rooks & black, board.rooks & white,
+                 board.queens & black, board.queens & white, board.kings & black, board.kings & white)
+        piece_hash = self.piece_hash
+        for index, (mask, previous) in enumerate(zip(masks, self.masks)):
+            changed = mask ^ previous
+            while changed:
+                square = (changed & -changed).bit_length() - 1
+                piece_hash ^= ZOBRIST_ARRAY[64 * index + square]
+                changed &= changed - 1
+        self.masks = masks
+        self.piece_hash = piece_hash
+        return (piece_hash ^ ZOBRIST_HASHER.hash_castling(board) ^ ZOBRIST_HASHER.hash_ep_square(board)
+                ^ ZOBRIST_HASHER.hash_turn(board))
+
+
+def position_fen(board):
+    return " ".join(board.fen().split(" ")[:-2])
 
 
 def get_points(result, color):
@@ -96,6 +570,14 @@ def get_points(result, color):
     return 0
 
 
+def nested_games_data(games_data):
+    # position -> year -> move -> {"games", "points"}, the layout calculate_percentage_and_points works on
+    nested = {}
+    for (position, year, move), (games, points) in games_data.items():
+        nested.setdefault(position, {}).setdefault(year, {})[move] = {"games": games, "points": points}
+    return nested
+
+
 def calculate_percentage_and_points(games_data, years):
     final_data = defaultdict(
         lambda:
@@ -107,7 +589,7 @@ def calculate_percentage_and_points(games_data, years):
         )
     )
 
-    for fen, years_data in games_data.items():
+    for position, years_data in games_data.items():
         for year, moves in years_data.items():
             year_int = int(year)
             for move, data in moves.items():
@@ -118,15 +600,71 @@ def calculate_percentage_and_points(games_data, years):
                 percentage = games / total_games if total_games > 0 else 0
                 avg_points = points / games if games > 0 else 0
 
-                final_data[fen][move][year_int] = [avg_points, percentage]
+                final_data[position][move][year_int] = [avg_points, percentage]
 
-    for fen, moves in final_data.items():
+    for position, moves in final_data.items():
         for move, year_data in moves.items():
             years_arr = np.array(list(year_data.keys()), dtype=int)  # Ensure years are integers
             data_arr = np.array([data for data in year_data.values()])
 
-            final_data[fen][move] = [
+            final_data[position][move] = [
                 [years_arr[i], *data_arr[i]] for i in range(len(years_arr))
             ]
 
     return final_data
+
+
+RAW_DTYPE = np.dtype([
+    ('position', '<u8'),
+    ('year', '<i2'),
+    ('move', 'S5'),
+    ('games', '<i8'),
+    ('points', '<f8'),
+])
+
+
+def raw_counts(games_data):
+    raw = np.array([
+        (position, year, move.encode(), games, points)
+        for (position, year, move), (games, points) in games_data.items()
+    ], dtype=RAW_DTYPE)
+    # Rows of a position together, then rows of a year, each in the order they were first counted
+    position_group, position_first = group_rows(raw['position'])
+    year_group, year_first = group_rows(raw['year'], raw['position'])
+    return raw[np.lexsort((np.arange(len(raw)), year_first[year_group], position_first[position_group]))]
+
+
+def aggregate_table(games_data):
+    # Same numbers and row order as to_table(calculate_percentage_and_points(...)),
+    # computed with grouped reductions over flat arrays
+    raw = raw_counts(games_data)
+
+    year_group, _ = group_rows(raw['year'], raw['position'])
+    total_games = np.bincount(year_group, weights=raw['games'])
+
+    table = np.empty(len(raw), dtype=STATS_DTYPE)
+    table['position'] = raw['position']
+    table['move'] = raw['move']
+    table['year'] = raw['year']
+    table['avg_points'] = raw['points'] / raw['games']
+    table['share'] = raw['games'] / total_games[year_group]
+
+    # Rows of one move stay together, ordered by the first appearance of the move in its position
+    _, move_codes = np.unique(raw['move'], return_inverse=True)
+    move_group, first_row = group_rows(move_codes.reshape(-1), raw['position'])
+    return table[np.lexsort((first_row[move_group], raw['position']))]
+
+
+def group_rows(*keys):
+    # Group ids for rows with equal keys (last key is the primary one, as in np.lexsort)
+    # and the first row of every group
+    order = np.lexsort(keys)
+    starts = np.zeros(len(order), dtype=bool)
+    starts[:1] = True
+    for key in keys:
+        sorted_key = key[order]
+        starts[1:] |= sorted_key[1:] != sorted_key[:-1]
+    groups = np.empty(len(order), dtype=np.intp)
+    groups[order] = np.cumsum(starts) - 1
+    # lexsort is stable, so the first sorted row of a group is also its earliest row
+    return groups, order[starts]
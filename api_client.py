@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from settings import SETTINGS
+
+
+class ApiClient:
+    # Requests run on worker threads, their callbacks are queued and run by dispatch() on the caller's
+    # thread (the Tk main loop in the GUI). Only the newest request of every kind delivers its result.
+    def __init__(self, search_player_url=None, search_games_url=None, cache_dir=None, cache_ttl=None,
+                 timeout=None, workers=2):
+        api_settings = SETTINGS['API']
+        self.search_player_url = search_player_url or api_settings['search_player']
+        self.search_games_url = search_games_url or api_settings['search_games']
+        self.cache_dir = cache_dir or api_settings.get('cache_dir', 'api_cache')
+        self.cache_ttl = cache_ttl if cache_ttl is not None else api_settings.get('cache_ttl', 24 * 3600)
+        self.timeout = timeout or api_settings.get('timeout', 30)
+
+        # One pooled session keeps connections to the API alive between requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.results = queue.Queue()
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def search_players(self, text, callback, error_callback=None):
+        url = self.search_player_url + urllib.parse.quote(text)
+        return self.submit('search_player', url, callback, error_callback)
+
+    def search_games(self, player, color, callback, error_callback=None, transform=None, progress_callback=None):
+        url = self.search_games_url + urllib.parse.quote(player) + "/" + urllib.parse.quote(color)
+        return self.submit('search_games', url, callback, error_callback, transform, progress_callback)
+
+    def submit(self, kind, url, callback, error_callback=None, transform=None, progress_callback=None):
+        # transform(result, report) runs on the worker thread, for work that should not block the caller
+        # either; values passed to report are delivered to progress_callback through dispatch()
+        with self.lock:
+            generation = self.generations.get(kind, 0) + 1
+            self.generations[kind] = generation
+
+        def report(value):
+            if progress_callback is not None:
+                self.results.put((kind, generation, progress_callback, value))
+
+        def run():
+            if not self.is_current(kind, generation):
+                return
+            try:
+                result = self.get_json(url)
+                if transform is not None:
+                    result = transform(result, report)
+            except Exception as e:
+                self.results.put((kind, generation, error_callback, e))
+                return
+            self.results.put((kind, generation, callback, result))
+
+        return self.executor.submit(run)
+
+    def cancel(self, kind):
+        with self.lock:
+            self.generations[kind] = self.generations.get(kind, 0) + 1
+
+    def is_current(self, kind, generation):
+        with self.lock:
+            return self.generations.get(kind) == generation
+
+    def dispatch(self):
+        while True:
+            try:
+                kind, generation, callback, result = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if not self.is_current(kind, generation):
+                continue
+            if callback is not None:
+                callback(result)
+            elif isinstance(result, Exception):
+                print(f"Request failed: {result}")
+
+    def get_json(self, url):
+        cache_path = self.cache_path(url)
+        if cache_path is not None and os.path.exists(cache_path) \
+                and time.time() - os.path.getmtime(cache_path) < self.cache_ttl:
+            with open(cache_path) as file:
+                return json.load(file)
+
+        res = self.session.get(url, timeout=self.timeout)
+        res.raise_for_status()
+        data = res.json()
+
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_path + '.tmp', 'w') as file:
+                json.dump(data, file)
+            os.replace(cache_path + '.tmp', cache_path)
+        return data
+
+    def cache_path(self, url):
+        if not self.cache_ttl:
+            return None
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
@@ -0,0 +1,747 @@
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from settings import SETTINGS
+from synthetic_pgn import generate_pgn
+
+
+def split_corpus(pgn_file, splitted_dir):
+    from split_pgn import split_pgn
+
+    os.makedirs(splitted_dir, exist_ok=True)
+    previous_dir = SETTINGS['splitted_pgns_dir']
+    SETTINGS['splitted_pgns_dir'] = splitted_dir
+    try:
+        split_pgn(pgn_file, splitted_dir + '_index')
+    finally:
+        SETTINGS['splitted_pgns_dir'] = previous_dir
+
+
+def count_games(directory):
+    games = 0
+    for file_name in os.listdir(directory):
+        with open(os.path.join(directory, file_name)) as file:
+            games += sum(1 for line in file if line.startswith('[Event '))
+    return games
+
+
+def worker_counts(max_workers):
+    counts = []
+    workers = 1
+    while workers < max_workers:
+        counts.append(workers)
+        workers *= 2
+    counts.append(max_workers)
+    return counts
+
+
+def bench_analyze_scaling(games=5000, max_workers=None, seed=0):
+    from analyze import analyze_dir
+
+    max_workers = max_workers or os.cpu_count()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        pgn_file = os.path.join(tmp, 'corpus.pgn')
+        splitted_dir = os.path.join(tmp, 'splitted')
+        generate_pgn(pgn_file, games, seed=seed)
+        split_corpus(pgn_file, splitted_dir)
+        # Every game is counted once per player file it was routed to
+        analyzed_games = count_games(splitted_dir)
+
+        for workers in worker_counts(max_workers):
+            # analyze_file removes its input, so every run works on a fresh copy
+            run_dir = os.path.join(tmp, f'run_{workers}')
+            out_dir = os.path.join(tmp, f'out_{workers}')
+            shutil.copytree(splitted_dir, run_dir)
+
+            start = time.perf_counter()
+            analyze_dir(run_dir, out_dir, workers=workers)
+            elapsed = time.perf_counter() - start
+
+            results.append({'workers': workers, 'seconds': elapsed, 'games_per_sec': analyzed_games / elapsed})
+            print(f"analyze_dir workers={workers:3d} {elapsed:8.2f}s {analyzed_games / elapsed:10.1f} games/s")
+    return results
+
+
+def bench_aggregation(games=20000, seed=0, repeat=3):
+    import chess.pgn
+    from analyze import aggregate_table, calculate_percentage_and_points, nested_games_data, new_games_data, \
+        process_game
+    from stats_table import to_table
+    from synthetic_pgn import generate_games
+
+    # Two players, so each has ~games/2 games per color
+    games_data = new_games_data()
+    years = []
+    for pgn in generate_games(games, players=2, seed=seed):
+        game = chess.pgn.read_game(io.StringIO(pgn))
+        if game.headers['White'] == 'Player000000, S':
+            process_game(game, 'white', games_data, years)
+    nested = nested_games_data(games_data)
+    print(f"{len(years)} games, {len(nested)} positions, {len(games_data)} (position, year, move) entries")
+
+    def best_of(function):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            table = function()
+            timings.append(time.perf_counter() - start)
+        return min(timings), table
+
+    reference_time, reference = best_of(lambda: to_table(calculate_percentage_and_points(nested, years)))
+    vectorized_time, vectorized = best_of(lambda: aggregate_table(games_data))
+    assert reference.tobytes() == vectorized.tobytes()
+
+    print(f"calculate_percentage_and_points {reference_time:8.3f}s")
+    print(f"aggregate_table                 {vectorized_time:8.3f}s  x{reference_time / vectorized_time:.1f}")
+    return {'games': len(years), 'reference_seconds': reference_time, 'vectorized_seconds': vectorized_time}
+
+
+def synthetic_tables(directory, positions, players=200, rows_per_player=20_000, seed=0):
+    from stats_table import STATS_DTYPE, TABLE_EXT, save_table
+
+    rng = np.random.default_rng(seed)
+    pool = rng.integers(0, 2 ** 64, size=positions, dtype=np.uint64)
+    # Every pool position is used at least once, popular ones by many players
+    order = rng.permutation(positions)
+    os.makedirs(directory, exist_ok=True)
+    for player in range(players):
+        own = order[player::players]
+        popular = np.minimum(rng.zipf(1.3, size=max(0, rows_per_player - len(own))) - 1, positions - 1)
+        table = np.zeros(len(own) + len(popular), dtype=STATS_DTYPE)
+        table['position'] = pool[np.concatenate((own, popular))]
+        table['move'] = rng.choice([b'e2e4', b'd2d4', b'g1f3', b'c2c4', b'e7e5', b'c7c5'], size=len(table))
+        table['year'] = rng.integers(1970, 2025, size=len(table))
+        table['avg_points'] = rng.random(len(table))
+        table['share'] = rng.random(len(table))
+        table = table[np.argsort(table['position'], kind='stable')]
+        save_table(table, os.path.join(directory, f"Player{player:06d}, S_white{TABLE_EXT}"))
+    return pool
+
+
+def bench_index_lookup(games=None, seed=0, positions=1_000_000, queries=10_000):
+    from opening_index import OpeningIndex, build_index
+
+    with tempfile.TemporaryDirectory() as tmp:
+        analyzed_dir = os.path.join(tmp, 'analyzed')
+        index_dir = os.path.join(tmp, 'index')
+        pool = synthetic_tables(analyzed_dir, positions, seed=seed)
+
+        start = time.perf_counter()
+        positions_count, rows_count = build_index(analyzed_dir, index_dir)
+        build_time = time.perf_counter() - start
+        print(f"build_index {positions_count} positions, {rows_count} rows in {build_time:.2f}s")
+
+        index = OpeningIndex(index_dir)
+        rng = np.random.default_rng(seed + 1)
+        latencies = []
+        for position in rng.choice(pool, size=queries).tolist():
+            start = time.perf_counter()
+            index.query(position)
+            latencies.append(time.perf_counter() - start)
+
+    latencies = np.array(latencies) * 1000
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f"query p50 {p50:.3f} ms, p99 {p99:.3f} ms, max {latencies.max():.3f} ms")
+    return {'positions': positions_count, 'rows': rows_count, 'build_seconds': build_time,
+            'p50_ms': p50, 'p99_ms': p99}
+
+
+def bench_scoring(games=None, seed=0, requests=512, concurrency=64, series_per_request=8):
+    import asyncio
+    import json as json_module
+    from learning import build_model
+    from predictor import Predictor
+    from scoring_service import ScoringService
+
+    # Latency does not depend on the weights, an untrained model of the same architecture is enough
+    predictor = Predictor()
+    predictor.model = build_model()
+    rng = np.random.default_rng(seed)
+    bodies = [
+        json_module.dumps({'series': rng.random((series_per_request, int(rng.integers(2, 30)), 2)).tolist()}).encode()
+        for _ in range(64)
+    ]
+
+    async def client(port, count):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for i in range(count):
+            body = bodies[i % len(bodies)]
+            writer.write(f"POST /score HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            length = 0
+            while (line := await reader.readline()) != b'\r\n':
+                if line.lower().startswith(b'content-length'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+        writer.close()
+
+    async def run():
+        service = ScoringService(predictor)
+        batcher_task = asyncio.create_task(service.batcher.run())
+        server = await asyncio.start_server(service.handle_connection, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        await asyncio.gather(*(client(port, requests // concurrency) for _ in range(concurrency)))
+        server.close()
+        batcher_task.cancel()
+        return service.metrics()
+
+    metrics = asyncio.run(run())
+    for name, value in metrics.items():
+        print(f"{name:24s} {value:12.3f}")
+    return metrics
+
+
+# Largest difference between the Keras model and its NumPy export that counts as the same output
+PARITY_TOLERANCE = 1e-5
+MIXED_PARITY_TOLERANCE = 1e-2
+
+
+def bench_model_runtime(games=None, seed=0, batch_size=64, length=30, repeat=20):
+    import subprocess
+    import sys
+    from learning import MASK_VALUE, build_model
+    from numpy_model import NumpyModel, export_model
+
+    model = build_model()
+    rng = np.random.default_rng(seed)
+    # The fresh model's output barely depends on its input, larger random weights make a wrong export show
+    model.set_weights([rng.normal(0, 0.3, weight.shape).astype(np.float32) for weight in model.get_weights()])
+    batch = rng.random((batch_size, length, 2)).astype(np.float32)
+    # Series of random lengths padded with MASK_VALUE, as in training, for the masked path of both models
+    padded = batch.copy()
+    for row, series_length in enumerate(rng.integers(1, length + 1, batch_size)):
+        padded[row, series_length:] = MASK_VALUE
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        keras_path = os.path.join(tmp_dir, 'model.keras')
+        numpy_path = os.path.join(tmp_dir, 'model_numpy.npz')
+        model.save(keras_path)
+        export_model(model, numpy_path)
+        numpy_model = NumpyModel.load(numpy_path)
+
+        # Only rounding differences are expected, larger ones on a GPU where Keras computes in float16
+        tolerance = PARITY_TOLERANCE if model.compute_dtype == 'float32' else MIXED_PARITY_TOLERANCE
+        difference = max(float(np.abs(np.asarray(model(x, training=False), dtype=np.float32)
+                                      - numpy_model(x)).max()) for x in (batch, padded))
+        print(f"max abs difference {difference:.2e}")
+        assert difference < tolerance, f"NumPy export differs from Keras by {difference}"
+
+        # Cold start: fresh interpreter, import, load and first prediction
+        loaders = {
+            'keras': f"import numpy as np, tensorflow as tf; m = tf.keras.models.load_model({keras_path!r}); "
+                     f"m(np.zeros((1, {length}, 2), 'float32'), training=False)",
+            'numpy': f"import numpy as np; from numpy_model import NumpyModel; m = NumpyModel.load({numpy_path!r}); "
+                     f"m(np.zeros((1, {length}, 2), 'float32'))",
+        }
+        cold_start = {}
+        for name, code in loaders.items():
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], check=True, capture_output=True)
+            cold_start[name] = time.perf_counter() - start
+
+    latency = {}
+    for name, run in (('keras', lambda: model(batch, training=False)), ('numpy', lambda: numpy_model(batch))):
+        run()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        latency[name] = (time.perf_counter() - start) / repeat
+
+    print(f"{'runtime':8s} {'cold start s':>12s} {'batch ms':>10s}")
+    for name in loaders:
+        print(f"{name:8s} {cold_start[name]:12.2f} {latency[name] * 1000:10.2f}")
+    return {'max_abs_difference': difference, 'cold_start_seconds': cold_start,
+            'batch_latency_ms': {name: value * 1000 for name, value in latency.items()}}
+
+
+def bench_import_time(games=None, seed=0, repeat=3):
+    import subprocess
+    import sys
+
+    # Fresh interpreter per module, best of a few runs, and which heavy dependencies the import pulled in
+    code = ("import sys, time; start = time.perf_counter(); import {module}; "
+            "print(time.perf_counter() - start, *[name for name in ('numpy', 'pymongo', 'tensorflow') "
+            "if name in sys.modules])")
+    results = {}
+    print(f"{'module':22s} {'import s':>9s}  loaded")
+    for module in ('gui', 'main', 'predictor', 'scoring_service', 'analyze', 'convert_moves2vector', 'learning'):
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', code.format(module=module)], check=True,
+                                    capture_output=True, text=True).stdout.split()
+            runs.append(float(output[0]))
+        results[module] = {'seconds': min(runs), 'loaded': output[1:]}
+        print(f"{module:22s} {min(runs):9.3f}  {' '.join(output[1:]) or '-'}")
+
+    if os.environ.get('DISPLAY'):
+        # Time until the board is drawn, the model keeps loading in the background
+        code = ("import time; start = time.perf_counter(); import tkinter as tk, gui; root = tk.Tk(); "
+                "gui.ChessApp(root); root.update(); print(time.perf_counter() - start); root.destroy()")
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+        results['gui_first_draw'] = {'seconds': float(output.split()[0])}
+        print(f"{'gui first draw':22s} {results['gui_first_draw']['seconds']:9.3f}")
+    return results
+
+
+def bench_ply_cost(games=5000, seed=0):
+    import chess.pgn
+    from analyze import PlyCounter, color_targets, new_games_data, process_game
+
+    def tree(pgn_file, color):
+        # Full GameNode tree from read_game, then a walk over its mainline
+        games_data = new_games_data()
+        counted = 0
+        with open(pgn_file) as pgn:
+            while (game := chess.pgn.read_game(pgn)) is not None:
+                counted += process_game(game, color, games_data, [])
+        return counted
+
+    def visitor(pgn_file, color):
+        games_data = new_games_data()
+        counter = PlyCounter(lambda headers: color_targets(games_data, color))
+        counted = 0
+        with open(pgn_file) as pgn:
+            while (plies := chess.pgn.read_game(pgn, Visitor=lambda: counter)) is not None:
+                counted += plies
+        return counted
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        pgn_file = os.path.join(tmp, 'corpus.pgn')
+        generate_pgn(pgn_file, games, seed=seed)
+        print(f"{'color':6s} {'parser':8s} {'seconds':>8s} {'plies':>9s} {'us/ply':>8s}")
+        for color in (None, 'white'):
+            timings = {}
+            for name, function in (('tree', tree), ('visitor', visitor)):
+                start = time.perf_counter()
+                plies = function(pgn_file, color)
+                timings[name] = time.perf_counter() - start
+                print(f"{color or 'both':6s} {name:8s} {timings[name]:8.2f} {plies:9d} "
+                      f"{timings[name] / plies * 1e6:8.1f}")
+                results.append({'color': color, 'parser': name, 'seconds': timings[name], 'plies': plies})
+            print(f"{color or 'both':6s} speedup x{timings['tree'] / timings['visitor']:.1f}")
+    return results
+
+
+def bench_pgn_index(games=20000, seed=0):
+    import chess.pgn
+    from pgn_index import build_pgn_index
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pgn_file = os.path.join(tmp, 'corpus.pgn')
+        generate_pgn(pgn_file, games, seed=seed)
+
+        # What split_pgn did for every game before the index: full parse and export
+        start = time.perf_counter()
+        with open(pgn_file) as pgn:
+            while (game := chess.pgn.read_game(pgn)) is not None:
+                game.accept(chess.pgn.StringExporter(headers=True))
+        parse_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indexed, players = build_pgn_index(pgn_file, os.path.join(tmp, 'index'))
+        index_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        split_corpus(pgn_file, os.path.join(tmp, 'splitted'))
+        split_time = time.perf_counter() - start
+
+    print(f"{indexed} games, {players} players")
+    print(f"read_game + export   {parse_time:8.2f}s {indexed / parse_time:10.0f} games/s")
+    print(f"build_pgn_index      {index_time:8.2f}s {indexed / index_time:10.0f} games/s")
+    print(f"split_pgn (indexed)  {split_time:8.2f}s {indexed / split_time:10.0f} games/s")
+    return {'games': indexed, 'parse_seconds': parse_time, 'index_seconds': index_time,
+            'split_seconds': split_time}
+
+
+def bench_split(games=50000, seed=0, players=5000):
+    from pgn_index import build_pgn_index
+    from split_pgn import split_pgn
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        pgn_file = os.path.join(tmp, 'corpus.pgn')
+        index_dir = os.path.join(tmp, 'index')
+        generate_pgn(pgn_file, games, players=players, seed=seed)
+        build_pgn_index(pgn_file, index_dir)
+
+        previous_dir = SETTINGS['splitted_pgns_dir']
+        try:
+            for mode, container, max_open in (('files', False, 64), ('files', False, 1024), ('container', True, None)):
+                splitted_dir = os.path.join(tmp, f'split_{mode}_{max_open}')
+                os.makedirs(splitted_dir)
+                SETTINGS['splitted_pgns_dir'] = splitted_dir
+
+                start = time.perf_counter()
+                routed, opens = split_pgn(pgn_file, index_dir, container=container, max_open=max_open)
+                elapsed = time.perf_counter() - start
+                files = len(os.listdir(splitted_dir))
+                print(f"{mode:9s} max_open={str(max_open):5s} {elapsed:7.2f}s {routed / elapsed:9.0f} games/s "
+                      f"{opens:7d} opens {files:6d} files")
+                results.append({'mode': mode, 'max_open': max_open, 'seconds': elapsed,
+                                'games_per_sec': routed / elapsed, 'file_opens': opens, 'files': files})
+                shutil.rmtree(splitted_dir)
+        finally:
+            SETTINGS['splitted_pgns_dir'] = previous_dir
+    return results
+
+
+def bench_series(games=None, seed=0, positions=2000, max_moves=8, first_year=1950, last_year=2024):
+    from stats_table import STATS_DTYPE, iter_position_rows, rows_to_moves, series_batch
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    for position in range(positions):
+        for move in range(int(rng.integers(1, max_moves + 1))):
+            years = np.flatnonzero(rng.random(last_year - first_year + 1) < rng.random()) + first_year
+            rows.extend((position, f"m{move}".encode(), year, rng.random(), rng.random()) for year in years)
+    table = np.array(rows, dtype=STATS_DTYPE)
+    position_rows = [rows for _, rows in iter_position_rows(table)]
+
+    def previous(rows):
+        # The per-move loop series were built with before series_batch
+        moves = rows_to_moves(rows)
+        last = max(int(year) for value in moves.values() for year, *_ in value)
+        series = {}
+        for move, value in moves.items():
+            included_years = [int(x[0]) for x in value]
+            filled_year = [[i, 0, 0] for i in range(min(included_years), last + 1) if i not in included_years]
+            series[move] = [rest for x, *rest in sorted(value + filled_year, key=lambda x: x[0])]
+        return series
+
+    timings = {}
+    for name, function in (('per-move loop', previous), ('series_batch', series_batch)):
+        start = time.perf_counter()
+        for rows in position_rows:
+            function(rows)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:14s} {timings[name]:7.2f}s {len(position_rows) / timings[name]:9.0f} positions/s")
+    print(f"{len(table)} rows, x{timings['per-move loop'] / timings['series_batch']:.1f}")
+    return timings
+
+
+# Documents read and padded together by the original learn(), before series were batched
+BASELINE_CHUNK = 32768 * 8
+
+
+def padded_steps(lengths, batch_size, boundaries=(), seed=0):
+    # GRU steps computed for the series batched in shuffled order, as make_dataset does: within every
+    # length bucket, batches are padded to their longest series
+    rng = np.random.default_rng(seed)
+    lengths = rng.permutation(lengths)
+    buckets = np.searchsorted(np.asarray(boundaries), lengths, side='right')
+    steps = 0
+    for bucket in np.unique(buckets):
+        bucket_lengths = lengths[buckets == bucket]
+        for start in range(0, len(bucket_lengths), batch_size):
+            batch = bucket_lengths[start:start + batch_size]
+            steps += len(batch) * batch.max()
+    return steps
+
+
+def bench_padding(games=20000, seed=0, batch_size=128, train_steps=20, inference_batch=256):
+    from analyze import analyze_dir
+    from convert_moves2vector import convert_file
+    from learning import MASK_VALUE, build_model, make_dataset, series_to_example
+    from numpy_model import NumpyModel, export_model
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pgn_file = os.path.join(tmp_dir, 'corpus.pgn')
+        generate_pgn(pgn_file, games, seed=seed)
+        split_corpus(pgn_file, os.path.join(tmp_dir, 'split'))
+        analyze_dir(os.path.join(tmp_dir, 'split'), os.path.join(tmp_dir, 'analyzed'))
+        analyzed_dir = os.path.join(tmp_dir, 'analyzed')
+        examples = [series_to_example(document['series']) for file_name in sorted(os.listdir(analyzed_dir))
+                    for document in convert_file(os.path.join(analyzed_dir, file_name))]
+    lengths = np.array([len(x) for x, _ in examples])
+    print(f"{len(examples)} series, length p50 {np.percentile(lengths, 50):.0f}, p99 {np.percentile(lengths, 99):.0f}, "
+          f"max {lengths.max()}")
+
+    # Steps the GRUs compute per real step of the series. The original learn() padded every chunk of
+    # BASELINE_CHUNK documents to its longest series with pad_sequences.
+    boundaries = (4, 8, 16, 32, 64)
+    chunks = [lengths[start:start + BASELINE_CHUNK] for start in range(0, len(lengths), BASELINE_CHUNK)]
+    waste = {
+        'padded to longest in chunk': sum(len(chunk) * chunk.max() for chunk in chunks),
+        'padded to longest in batch': padded_steps(lengths, batch_size, seed=seed),
+        'length buckets': padded_steps(lengths, batch_size, boundaries, seed=seed),
+    }
+    print(f"{'training batches':28s} {'padding waste':>13s}")
+    for name, steps in waste.items():
+        waste[name] = 1 - lengths.sum() / steps
+        print(f"{name:28s} {waste[name]:12.1%}")
+
+    # CPU training throughput of the original padded chunk and of the dataset pipeline, with and without bucketing
+    rng = np.random.default_rng(seed)
+    chunk = rng.permutation(min(len(examples), BASELINE_CHUNK))[:(train_steps + 3) * batch_size]
+    x = np.full((len(chunk), lengths[:BASELINE_CHUNK].max(), 2), MASK_VALUE, dtype=np.float32)
+    for row, i in enumerate(chunk):
+        x[row, :lengths[i]] = examples[i][0]
+    y = np.array([examples[i][1] for i in chunk], dtype=np.float32)
+    model = build_model()
+    model.fit(x[:3 * batch_size], y[:3 * batch_size], batch_size=batch_size, epochs=1, verbose=0)
+    start = time.perf_counter()
+    model.fit(x[3 * batch_size:], y[3 * batch_size:], batch_size=batch_size, epochs=1, verbose=0)
+    throughput = {'padded to longest in chunk': (len(chunk) - 3 * batch_size) / (time.perf_counter() - start)}
+
+    shard_readers = [lambda shard=shard: iter(examples[shard::4]) for shard in range(4)]
+    for name, bucket_boundaries in (('padded to longest in batch', ()), ('length buckets', boundaries)):
+        model = build_model()
+        dataset = make_dataset(shard_readers, range(4), batch_size, shuffle_buffer=10_000,
+                               bucket_boundaries=bucket_boundaries).repeat()
+        model.fit(dataset, steps_per_epoch=3, epochs=1, verbose=0)
+        start = time.perf_counter()
+        model.fit(dataset, steps_per_epoch=train_steps, epochs=1, verbose=0)
+        throughput[name] = train_steps * batch_size / (time.perf_counter() - start)
+    print(f"{'training':28s} {'samples/s':>13s}")
+    for name, value in throughput.items():
+        print(f"{name:28s} {value:13.0f}")
+
+    # NumPy inference of one padded batch: every step of every row, or only the steps of each series
+    chosen = rng.choice(len(examples), inference_batch, replace=False)
+    batch = np.full((inference_batch, lengths[chosen].max(), 2), -1, dtype=np.float32)
+    for row, i in enumerate(chosen):
+        batch[row, :lengths[i]] = examples[i][0]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        export_model(model, os.path.join(tmp_dir, 'model.npz'))
+        masked = NumpyModel.load(os.path.join(tmp_dir, 'model.npz'))
+    unmasked = NumpyModel([entry for entry in masked.spec if entry['type'] != 'masking'],
+                          [weights for entry, weights in zip(masked.spec, masked.weights) if entry['type'] != 'masking'])
+    inference = {}
+    for name, numpy_model in (('every padded step', unmasked), ('masked, ragged', masked)):
+        numpy_model(batch)
+        start = time.perf_counter()
+        for _ in range(5):
+            numpy_model(batch)
+        inference[name] = 5 * inference_batch / (time.perf_counter() - start)
+    print(f"{'numpy inference':28s} {'samples/s':>13s}")
+    for name, value in inference.items():
+        print(f"{name:28s} {value:13.0f}")
+    return {'series': len(examples), 'padding_waste': waste, 'train_samples_per_sec': throughput,
+            'inference_samples_per_sec': inference}
+
+
+SCALES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000}
+PIPELINE_STAGES = ('generate', 'index', 'split', 'analyze', 'analyze_pgn', 'convert', 'learn')
+TRAIN_SHARD_SIZE = 10_000
+
+
+def pipeline_stage(stage, work_dir, corpus, games, seed, context, max_train_docs=10_000, epochs=1):
+    # One stage of bench_pipeline, returns what it processed. Earlier stages' results are in context.
+    paths = {name: os.path.join(work_dir, name) for name in
+             ('index', 'split', 'analyzed', 'analyzed_pgn', 'state', 'vectors', 'train_vectors', 'model', 'logs')}
+
+    if stage == 'generate':
+        if os.path.exists(corpus):
+            return {'games': games, 'cached': True}
+        generate_pgn(corpus + '.tmp', games, seed=seed)
+        os.replace(corpus + '.tmp', corpus)
+        return {'games': games}
+
+    if stage == 'index':
+        from pgn_index import build_pgn_index
+
+        indexed, players = build_pgn_index(corpus, paths['index'])
+        return {'games': indexed, 'players': players}
+
+    if stage == 'split':
+        from split_pgn import split_pgn
+
+        os.makedirs(paths['split'])
+        SETTINGS['splitted_pgns_dir'] = paths['split']
+        routed, opens = split_pgn(corpus, paths['index'])
+        return {'games': routed, 'files': len(os.listdir(paths['split'])), 'file_opens': opens}
+
+    if stage == 'analyze':
+        from analyze import analyze_dir
+
+        analyze_dir(paths['split'], paths['analyzed'])
+        return {'games': context['split']['games'], 'files': context['split']['files']}
+
+    if stage == 'analyze_pgn':
+        from analyze import analyze_pgn
+
+        parsed = analyze_pgn(corpus, paths['analyzed_pgn'], state_dir=paths['state'])
+        return {'games': parsed, 'files': len(os.listdir(paths['analyzed_pgn']))}
+
+    if stage == 'convert':
+        from convert_moves2vector import FileSink, convert_dir
+
+        docs = convert_dir(paths['analyzed'], sink=FileSink(paths['vectors'], shard_size=TRAIN_SHARD_SIZE))
+        return {'docs': docs, 'files': context['split']['files']}
+
+    if stage == 'learn':
+        from learning import learn
+        from vector_shards import list_shards
+
+        # A bounded sample of the shards is enough for a stable samples/sec
+        os.makedirs(paths['train_vectors'])
+        for path in list_shards(paths['vectors'])[:max(1, max_train_docs // TRAIN_SHARD_SIZE)]:
+            shutil.copy(path, paths['train_vectors'])
+        SETTINGS.update({'training_source': 'files', 'vectors_dir': paths['train_vectors'],
+                         'model_dir': paths['model'], 'tensorboard_log_dir': paths['logs'] + '/'})
+        logs = learn(epochs=epochs).history
+        return {'samples': int(logs['samples_per_sec'][-1] * logs['train_seconds'][-1]),
+                'train_seconds': logs['train_seconds'][-1], 'samples_per_sec': logs['samples_per_sec'][-1],
+                'loss': logs['loss'][-1]}
+
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def stage_process(stage, args, results):
+    import resource
+
+    try:
+        start = time.perf_counter()
+        result = pipeline_stage(stage, *args)
+        result['seconds'] = time.perf_counter() - start
+        # Worker pools of the stage are its children, their peak is reported separately
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        result['children_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    except Exception as e:
+        result = {'error': repr(e)}
+    results.put(result)
+
+
+def git_commit():
+    import subprocess
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                                check=True).stdout
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.strip(), bool(status.strip())
+
+
+def bench_pipeline(games=5000, seed=0, scale=None, stages=None, output_dir='benchmark_results',
+                   data_dir='benchmark_data', max_train_docs=10_000, epochs=1):
+    # Every stage runs in a fresh process, so its timing and peak RSS are its own. Corpora are cached
+    # in data_dir by size and seed, results are written as json for comparing commits.
+    import json
+    import multiprocessing
+    import platform
+    import queue
+
+    games = SCALES[scale] if scale else games
+    stages = stages or PIPELINE_STAGES
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    corpus = os.path.join(data_dir, f"corpus_{games}_{seed}.pgn")
+    work_dir = tempfile.mkdtemp(prefix='pipeline_', dir=data_dir)
+    context = multiprocessing.get_context('spawn')
+
+    results = {}
+    print(f"{'stage':12s} {'seconds':>9s} {'rate':>24s} {'peak RSS MB':>12s} {'workers MB':>11s}")
+    try:
+        for stage in stages:
+            stage_results = context.Queue()
+            process = context.Process(target=stage_process, args=(
+                stage, (work_dir, corpus, games, seed, results, max_train_docs, epochs), stage_results))
+            process.start()
+            while True:
+                try:
+                    result = stage_results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        result = {'error': f"exit code {process.exitcode}"}
+                        break
+            process.join()
+            results[stage] = result
+            if 'error' in result:
+                print(f"{stage:12s} failed: {result['error']}")
+                break
+
+            for unit in ('games', 'files', 'docs'):
+                if unit in result:
+                    result[f'{unit}_per_sec'] = result[unit] / result['seconds']
+            rate_unit = next(unit for unit in ('docs', 'samples', 'games') if f'{unit}_per_sec' in result)
+            print(f"{stage:12s} {result['seconds']:9.2f} {result[f'{rate_unit}_per_sec']:14.0f} "
+                  f"{rate_unit + '/s':9s} {result['peak_rss_mb']:12.0f} {result['children_peak_rss_mb']:11.0f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit, dirty = git_commit()
+    report = {
+        'benchmark': 'pipeline',
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'games': games,
+        'seed': seed,
+        'stages': results,
+    }
+    path = os.path.join(output_dir, f"pipeline_{games}_{(commit or 'unknown')[:10]}_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {path}")
+    return report
+
+
+def compare_pipeline(old_path, new_path):
+    import json
+
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    print(f"{(old['commit'] or '?')[:10]} -> {(new['commit'] or '?')[:10]}, {old['games']} / {new['games']} games")
+    print(f"{'stage':12s} {'old s':>9s} {'new s':>9s} {'speedup':>8s} {'old MB':>8s} {'new MB':>8s}")
+    for stage in PIPELINE_STAGES:
+        if 'seconds' not in old['stages'].get(stage, {}) or 'seconds' not in new['stages'].get(stage, {}):
+            continue
+        old_stage, new_stage = old['stages'][stage], new['stages'][stage]
+        print(f"{stage:12s} {old_stage['seconds']:9.2f} {new_stage['seconds']:9.2f} "
+              f"{old_stage['seconds'] / new_stage['seconds']:7.2f}x "
+              f"{old_stage['peak_rss_mb']:8.0f} {new_stage['peak_rss_mb']:8.0f}")
+
+
+BENCHMARKS = {
+    'analyze_scaling': bench_analyze_scaling,
+    'aggregation': bench_aggregation,
+    'ply_cost': bench_ply_cost,
+    'pgn_index': bench_pgn_index,
+    'split': bench_split,
+    'series': bench_series,
+    'padding': bench_padding,
+    'pipeline': bench_pipeline,
+    'index_lookup': bench_index_lookup,
+    'scoring': bench_scoring,
+    'model_runtime': bench_model_runtime,
+    'import_time': bench_import_time,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=list(BENCHMARKS) + ['compare'])
+    parser.add_argument('results', nargs='*', help="compare: two result files of the pipeline benchmark")
+    parser.add_argument('--games', type=int, help="corpus size, each benchmark's own default otherwise")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', choices=SCALES, help="pipeline: corpus size, overrides --games")
+    parser.add_argument('--stages', help="pipeline: comma separated stages, all by default")
+    parser.add_argument('--output-dir', default='benchmark_results', help="pipeline: where results are written")
+    args = parser.parse_args()
+    options = {'seed': args.seed}
+    if args.games is not None:
+        options['games'] = args.games
+
+    if args.benchmark == 'compare':
+        compare_pipeline(*args.results)
+    elif args.benchmark == 'pipeline':
+        bench_pipeline(**options, scale=args.scale,
+                       stages=args.stages.split(',') if args.stages else None, output_dir=args.output_dir)
+    else:
+        BENCHMARKS[args.benchmark](**options)
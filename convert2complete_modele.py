@@ -1,5 +1,8 @@
+import sys
+
 import tensorflow as tf
 # import tensorflowjs as tfjs
+from numpy_model import NUMPY_MODEL_FILE, export_model
 from settings import SETTINGS
 
 
@@ -11,5 +14,16 @@ def convert2complete_model():
     # tfjs.converters.save_keras_model(model, 'model_js')
 
 
+def export_numpy_model(model_path=None, out_path=None):
+    # Weights for the TensorFlow free runtime used by the GUI and the scoring service
+    model = tf.keras.models.load_model(model_path or SETTINGS['model_dir'] + '/model.keras')
+    out_path = out_path or SETTINGS['model_dir'] + '/' + NUMPY_MODEL_FILE
+    export_model(model, out_path)
+    print(f"Saved {out_path}")
+
+
 if __name__ == '__main__':
-    convert2complete_model()
+    if len(sys.argv) > 1 and sys.argv[1] == 'numpy':
+        export_numpy_model()
+    else:
+        convert2complete_model()
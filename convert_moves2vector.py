@@ -1,73 +1,157 @@
 import os
-import pickle
+import shutil
+import time
 from datetime import datetime
-
-from pymongo import MongoClient
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 
 from settings import SETTINGS
+from stats_table import iter_position_rows, load_table, series_batch
+from telemetry import get_telemetry
+from vector_shards import SHARD_EXT, list_shards, write_shard
+
+MAX_YEARS_SPAN = 120
+
+
+class MongoSink:
+    def __init__(self, batch_size=50_000):
+        from pymongo import MongoClient
+
+        connection_string = f"mongodb://{SETTINGS['mongo']['host']}:{SETTINGS['mongo']['port']}"
+        self.client = MongoClient(connection_string)
+        self.collection = self.client[SETTINGS['mongo']['database']][SETTINGS['mongo']['collection']]
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def open(self, resume=False):
+        # A resumed conversion adds to the documents written before it stopped
+        if not resume:
+            self.collection.drop()
+
+    def write(self, documents):
+        self.buffer.extend(documents)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self.buffer:
+            # Unordered bulk insert, the server does not stop or serialize on a single failed document
+            self.collection.insert_many(self.buffer, ordered=False)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.client.close()
+
+
+class FileSink:
+    def __init__(self, directory=None, shard_size=200_000):
+        self.directory = directory or SETTINGS['vectors_dir']
+        self.shard_size = shard_size
+        self.buffer = []
+        self.shard_count = 0
+
+    def open(self, resume=False):
+        # A resumed conversion adds shards after the ones written before it stopped
+        if resume and os.path.exists(self.directory):
+            self.shard_count = len(list_shards(self.directory))
+            return
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+    def write(self, documents):
+        self.buffer.extend(documents)
+        if len(self.buffer) >= self.shard_size:
+            self.flush()
+            return True
+        return False
 
-connection_string = f"mongodb://{SETTINGS['mongo']['host']}:{SETTINGS['mongo']['port']}"
-client = MongoClient(connection_string)
-db = client[SETTINGS['mongo']['database']]
-collection = db[SETTINGS['mongo']['collection']]
+    def flush(self):
+        if self.buffer:
+            write_shard(os.path.join(self.directory, f"shard_{self.shard_count:05d}{SHARD_EXT}"), self.buffer)
+            self.shard_count += 1
+            self.buffer = []
 
+    def close(self):
+        self.flush()
 
-def convert_dir(directory, batch_size=1000):
-    collection.drop()
+
+SINKS = {
+    'mongo': MongoSink,
+    'files': FileSink,
+}
+
+
+def convert_dir(directory, batch_size=1000, sink=None, workers=None, chunksize=8, remove_inputs=True, skip=(),
+                on_flushed=None, resume=False):
+    # on_flushed(file_names) is called once the documents of the files are in the sink, files named
+    # in skip are left out. resume=True keeps what the sink already holds.
+    sink = sink or MongoSink()
+    sink.open(resume)
+    skip = set(skip)
     file_paths = [os.path.join(directory, file_name) for file_name in os.listdir(directory) if
-                  os.path.isfile(os.path.join(directory, file_name))]
-    for i in range(0, len(file_paths), batch_size):
-        batch = file_paths[i:i + batch_size]
-        with ThreadPoolExecutor() as executor:
-            futures = {executor.submit(convert_file, fp): fp for fp in batch}
-            for future in as_completed(futures):
-                file_path = futures[future]
-                try:
-                    documents = future.result()
-                    if documents:
-                        collection.insert_many(documents)
-                    os.remove(file_path)
-                except Exception as e:
-                    print(f"Error processing {file_path}: {e}")
+                  os.path.isfile(os.path.join(directory, file_name)) and file_name not in skip]
+
+    docs_count = 0
+    telemetry = get_telemetry()
+    telemetry.progress(len(file_paths), rates=('docs',))
+    # Inputs are removed only once their documents have been flushed to the sink
+    written_paths = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(file_paths), batch_size):
+            batch = file_paths[i:i + batch_size]
+            for file_path, documents, error, seconds in executor.map(convert_file_task, batch, chunksize=chunksize):
+                telemetry.advance()
+                if error is not None:
+                    telemetry.error(file_path, error)
+                    continue
+                telemetry.observe('file_seconds', seconds, file_path)
+                telemetry.count('docs', len(documents))
+                written_paths.append(file_path)
+                docs_count += len(documents)
+                # Timed as a whole, a write that fills the buffer includes the flush to the sink
+                start = time.perf_counter()
+                if sink.write(documents):
+                    telemetry.observe('flush_seconds', time.perf_counter() - start)
+                    flushed(written_paths, remove_inputs, on_flushed)
+
+    with telemetry.timer('flush_seconds'):
+        sink.close()
+    flushed(written_paths, remove_inputs, on_flushed)
+    return docs_count
+
+
+def flushed(file_paths, remove_inputs, on_flushed):
+    if on_flushed is not None:
+        on_flushed([os.path.basename(file_path) for file_path in file_paths])
+    if remove_inputs:
+        for file_path in file_paths:
+            os.remove(file_path)
+    file_paths.clear()
+
+
+def convert_file_task(file_path):
+    start = time.perf_counter()
+    try:
+        documents = convert_file(file_path)
+    except Exception as e:
+        return file_path, None, str(e), time.perf_counter() - start
+    return file_path, documents, None, time.perf_counter() - start
 
 
 def convert_file(filename):
-    with open(filename, 'rb') as file:
-        data = pickle.load(file)
-        documents = []
-
-        for fen, fen_data in data.items():
-            last_year = 0
-            for move, move_data_list in fen_data.items():
-                included_years = [int(x[0]) for x in move_data_list]
-                first_year = int(min(included_years))
-                last_year_tmp = int(max(included_years))
-                if last_year_tmp-first_year > 120:
-                    continue
-                last_year = max(last_year_tmp, last_year)
+    table = load_table(filename)
+    documents = []
 
-            for move, move_data_list in fen_data.items():
-                included_years = [int(x[0]) for x in move_data_list]
-                first_year = int(min(included_years))
-                last_year_tmp = int(max(included_years))
-                if last_year_tmp-first_year > 120:
-                    continue
-                filled_year = []
-                for i in range(first_year, last_year):
-                    if i not in included_years:
-                        filled_year.append([i, 0, 0])
-                data = sorted(move_data_list[:-120] + filled_year, key=lambda x: x[0])
-                time_series = [rest for x, *rest in data]
-
-                if len(time_series) > 1:
-                    documents.append({
-                        'series': time_series,
-                        'first_year': first_year,
-                        'last_year': last_year
-                    })
-        return documents
-
-
-if __name__ == "__main__":
-    convert_dir(SETTINGS['analyzed_games'])
+    for position, rows in iter_position_rows(table):
+        _, batch, lengths, first_years, last_year = series_batch(rows, max_span=MAX_YEARS_SPAN)
+        for series, length, first_year in zip(batch.tolist(), lengths.tolist(), first_years.tolist()):
+            if length > 1:
+                documents.append({
+                    'series': series[:length],
+                    'first_year': first_year,
+                    'last_year': last_year
+                })
+    return documents
@@ -1,19 +1,14 @@
 import math
-import pickle
+import threading
 import tkinter as tk
 from tkinter import ttk
 import chess
-import urllib.parse
-import tempfile
 
-import requests
-import os
-import numpy as np
-from datetime import datetime
+from api_client import ApiClient
 
-from analyze import analyze_file
-from learning import load_and_predict
-from settings import SETTINGS
+SEARCH_DELAY_MS = 300
+API_POLL_MS = 50
+PROGRESS_EVERY = 100
 
 CHESS_PIECES = {
     "p": "♟",
@@ -38,8 +33,15 @@ class ChessApp:
         self.board = chess.Board()
         self.selected_square = None
 
-        self.fen_obj = {}
+        self.position_table = None
+        self.dataset_key = None
+        # Set by the warm-up thread once the model is loaded, analysis and numpy are imported there too
+        self.predictor = None
+        self.warm_up_thread = None
+        self.warm_up_error = None
         self.predictions = []
+        self.api = ApiClient()
+        self.search_after_id = None
 
         self.input_var = tk.StringVar()
         self.input_entry = ttk.Combobox(self.master, textvariable=self.input_var)
@@ -56,6 +58,9 @@ class ChessApp:
         self.submit_button = tk.Button(self.master, text="Submit", command=self.submit_input)
         self.submit_button.pack(pady=10)
 
+        self.status_var = tk.StringVar(value="")
+        tk.Label(self.master, textvariable=self.status_var).pack()
+
         self.canvas = tk.Canvas(self.master, width=400, height=400)
         self.canvas.pack()
         self.canvas.bind("<Button-1>", self.on_click)
@@ -80,6 +85,32 @@ class ChessApp:
         self.prediction_container.bind("<Configure>", self.on_frame_configure)
 
         self.draw_board()
+        self.master.after(API_POLL_MS, self.process_api_results)
+        self.master.after_idle(self.start_warm_up)
+
+    def start_warm_up(self):
+        self.status_var.set("Loading model...")
+        self.warm_up_thread = threading.Thread(target=self.warm_up, daemon=True)
+        self.warm_up_thread.start()
+
+    def warm_up(self):
+        try:
+            import analyze  # noqa: F401
+            from predictor import get_predictor
+
+            predictor = get_predictor()
+            predictor.load()
+            self.predictor = predictor
+        except Exception as e:
+            self.warm_up_error = e
+
+    def on_model_ready(self):
+        if self.predictor is None:
+            print(f"Loading model failed: {self.warm_up_error}")
+            self.status_var.set("Model not available")
+            return
+        self.status_var.set("")
+        self.predicate()
 
     def undo_move(self):
         if self.board.move_stack:
@@ -121,123 +152,112 @@ class ChessApp:
             move = chess.Move(self.selected_square, clicked_square)
             if move in self.board.legal_moves:
                 self.board.push(move)
-                print("FEN:", " ".join(self.board.fen().split(" ")[:-2]))
+                from analyze import position_fen
+                print("FEN:", position_fen(self.board))
                 self.predicate()
             self.selected_square = None
 
         self.draw_board()
 
     def on_keyrelease(self, event):
+        # Wait until typing pauses, older searches are dropped by the client
+        if self.search_after_id is not None:
+            self.master.after_cancel(self.search_after_id)
+            self.search_after_id = None
+
         text = self.input_var.get()
         if len(text) >= 4:
-            url = SETTINGS["API"]["search_player"] + urllib.parse.quote(text)
-            res = requests.get(url)
-            try:
-                self.input_entry['values'] = res.json()
-            except:
-                self.input_entry['values'] = []
+            self.search_after_id = self.master.after(SEARCH_DELAY_MS, self.search_players, text)
         else:
+            self.api.cancel('search_player')
             self.input_entry['values'] = []
 
-    def submit_input(self):
-        input_value = self.input_var.get()
-        selected_color = self.color_var.get()
-        url = SETTINGS["API"]["search_games"] + urllib.parse.quote(input_value) + "/" + urllib.parse.quote(
-            selected_color)
-
-        try:
-            res = requests.get(url)
-            res.raise_for_status()  # Raises HTTPError for bad responses
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
-            return
-
-        data = res.json()
-        pgn = "\n".join((row2pgn(x) for x in data))
-        temp_file = tempfile.NamedTemporaryFile(suffix=f"{input_value}_none.pgn", delete=False)
-
-        with open(temp_file.name, 'w') as file:
-            file.write(pgn)
+    def search_players(self, text):
+        self.search_after_id = None
+        self.api.search_players(text, self.show_players, lambda e: self.show_players([]))
 
-        temp_file.close()
-        temp_dir = tempfile.TemporaryDirectory()
+    def show_players(self, players):
+        self.input_entry['values'] = players if isinstance(players, list) else []
 
-        analyze_file(temp_file.name, temp_dir.name)
-        file_name_without_ext = os.path.splitext(os.path.basename(temp_file.name))[0]
+    def process_api_results(self):
+        self.api.dispatch()
+        if self.warm_up_thread is not None and not self.warm_up_thread.is_alive():
+            self.warm_up_thread = None
+            self.on_model_ready()
+        self.master.after(API_POLL_MS, self.process_api_results)
 
-        with open(f"{temp_dir.name}/{file_name_without_ext}.pkl", 'rb') as file:
-            self.fen_obj = pickle.load(file)
+    def submit_input(self):
+        input_value = self.input_var.get()
+        selected_color = self.color_var.get()
+        self.status_var.set(f"Loading {input_value}...")
+        self.api.search_games(
+            input_value,
+            selected_color,
+            lambda table: self.load_games(input_value, selected_color, table),
+            self.on_games_error,
+            transform=analyze_rows,
+            progress_callback=lambda count: self.status_var.set(f"Analyzing {input_value}: {count} games"),
+        )
+
+    def on_games_error(self, e):
+        print(f"Request failed: {e}")
+        self.status_var.set("")
+
+    def load_games(self, input_value, selected_color, table):
+        self.position_table = table
+        self.dataset_key = (input_value, selected_color)
+        if self.predictor is not None:
+            self.predictor.clear_cache()
+        self.status_var.set(f"{input_value}: {len(table)} moves")
 
         self.board = chess.Board()
         self.draw_board()
 
         self.predicate()
 
-        temp_dir.cleanup()
-
     def predicate(self):
         self.predictions.clear()
         for widget in self.prediction_container.winfo_children():
             widget.destroy()
 
-        try:
-            fen = " ".join(self.board.fen().split(" ")[:-2])
-            last_year = 0
-            for key in self.fen_obj[fen]:
-                value = self.fen_obj[fen][key]
-
-                included_years = [int(x[0]) for x in value]
-                last_year = max(int(max(included_years)), last_year)
-
-            for key in self.fen_obj[fen]:
-                value = self.fen_obj[fen][key]
-
-                included_years = [int(x[0]) for x in value]
-                first_year = int(min(included_years))
-                filled_year = []
-                for i in range(first_year, last_year):
-                    if i not in included_years:
-                        filled_year.append([i, 0, 0])
-                data = sorted(value + filled_year, key=lambda x: x[0])
-                time_series = [rest for x, *rest in data]
-
-                predictions = load_and_predict(
-                    np.array(
-                        [
-                            time_series
-                        ]
-                    )
-                )
-                prediction_value = predictions[0][0]
-                print(f"{key} {prediction_value}")
-                print(f"{time_series}")
-                print(f"{prediction_value}")
-
-                try:
-                    log_value = 1 / (math.log(prediction_value, 1 / 32) + 1)
-                except:
-                    log_value = 0
-                print(f"{key} {log_value * 100}")
-                self.predictions.append((key, prediction_value, prediction_value * 100))
-
-            # Sort predictions in descending order by prediction_value
-            self.predictions.sort(key=lambda x: x[1], reverse=True)
-
-            for move, prediction_value, percent_value in self.predictions:
-                row_frame = tk.Frame(self.prediction_container)
-                row_frame.pack(fill=tk.X, pady=2)
-
-                move_label = tk.Label(row_frame, text=move)
-                move_label.pack(side=tk.LEFT, padx=5)
-
-                progress = ttk.Progressbar(row_frame, orient="horizontal", length=300, mode="determinate")
-                progress['value'] = percent_value
-                progress.pack(side=tk.LEFT, padx=5)
-
-            print("=" * 50)
-
-        except KeyError:
-            pass
+        if self.position_table is None or self.predictor is None:
+            return
+
+        from analyze import position_key
+        from stats_table import position_series
+
+        position = position_key(self.board)
+        moves, batch, lengths, _, _ = position_series(self.position_table, position)
+        if not moves:
+            return
+
+        predictions = self.predictor.predict_moves((position, self.dataset_key), moves, batch, lengths)
+        for i, (key, prediction_value) in enumerate(predictions):
+            print(f"{key} {prediction_value}")
+            print(f"{batch[i, :lengths[i]].tolist()}")
+
+            try:
+                log_value = 1 / (math.log(prediction_value, 1 / 32) + 1)
+            except:
+                log_value = 0
+            print(f"{key} {log_value * 100}")
+            self.predictions.append((key, prediction_value, prediction_value * 100))
+
+        # Sort predictions in descending order by prediction_value
+        self.predictions.sort(key=lambda x: x[1], reverse=True)
+
+        for move, prediction_value, percent_value in self.predictions:
+            row_frame = tk.Frame(self.prediction_container)
+            row_frame.pack(fill=tk.X, pady=2)
+
+            move_label = tk.Label(row_frame, text=move)
+            move_label.pack(side=tk.LEFT, padx=5)
+
+            progress = ttk.Progressbar(row_frame, orient="horizontal", length=300, mode="determinate")
+            progress['value'] = percent_value
+            progress.pack(side=tk.LEFT, padx=5)
+
+        print("=" * 50)
 
     def on_frame_configure(self, event):
         self.prediction_canvas.configure(scrollregion=self.prediction_canvas.bbox("all"))
@@ -246,6 +266,17 @@ class ChessApp:
         self.prediction_canvas.configure(scrollregion=self.prediction_canvas.bbox("all"))
 
 
+def analyze_rows(data, report=None):
+    # Runs on the api client's worker thread, games are analyzed in memory as they are converted
+    from analyze import analyze_games
+
+    def progress(count):
+        if report is not None and count % PROGRESS_EVERY == 0:
+            report(count)
+
+    return analyze_games((row2pgn(x) for x in data), progress=progress)
+
+
 def row2pgn(row):
     return f"""[Event "{row["Event"]}"]
 [Site "{row["Site"]}"]
@@ -3,109 +3,306 @@ from tensorflow.keras import layers, models, mixed_precision
 import numpy as np
 import datetime
 import os
-from pymongo import MongoClient
+import threading
+import time
+from predictor import get_predictor
 from settings import SETTINGS
-from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
-
-mixed_precision.set_global_policy('mixed_float16')
-
-gpus = tf.config.list_physical_devices('GPU')
-if gpus:
-    try:
-        tf.config.set_visible_devices(gpus[0], 'GPU')
-        tf.config.experimental.set_memory_growth(gpus[0], True)
-    except RuntimeError as e:
-        print(f"Error setting up GPU memory growth: {e}")
-
-connection_string = f"mongodb://{SETTINGS['mongo']['host']}:{SETTINGS['mongo']['port']}"
-client = MongoClient(connection_string)
-db = client[SETTINGS['mongo']['database']]
-collection = db[SETTINGS['mongo']['collection']]
-
-early_stopping = EarlyStopping(
-    monitor='loss',
-    patience=30,
-    restore_best_weights=True,
-)
-
-reduce_lr = ReduceLROnPlateau(
-    monitor='loss',
-    factor=0.1,
-    patience=10,
-    min_lr=1e-7
-)
-
-
-def learn(batch_size=32768 * 8, epochs=1000, train_batch_size=128):
-    model_name = f"R2_M3_B1_{epochs}_{train_batch_size}_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+from telemetry import get_telemetry
+from vector_shards import iter_series, list_shards
+from tensorflow.keras.callbacks import BackupAndRestore, EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
+
+_collection = None
+_tensorflow_ready = False
+
+
+def setup_tensorflow():
+    # Done on first use instead of at import time, importing this module does not touch the GPU
+    global _tensorflow_ready
+    if _tensorflow_ready:
+        return
+    _tensorflow_ready = True
+
+    gpus = tf.config.list_physical_devices('GPU')
+    if gpus:
+        # float16 is only fast on the GPU, on the CPU it is emulated and training is ~100x slower
+        mixed_precision.set_global_policy('mixed_float16')
+        try:
+            tf.config.set_visible_devices(gpus[0], 'GPU')
+            tf.config.experimental.set_memory_growth(gpus[0], True)
+        except RuntimeError as e:
+            print(f"Error setting up GPU memory growth: {e}")
+
+
+def get_collection():
+    global _collection
+    if _collection is None:
+        from pymongo import MongoClient
+
+        connection_string = f"mongodb://{SETTINGS['mongo']['host']}:{SETTINGS['mongo']['port']}"
+        client = MongoClient(connection_string)
+        _collection = client[SETTINGS['mongo']['database']][SETTINGS['mongo']['collection']]
+    return _collection
+
+
+# Padding of the input series. Zeros are real data (years a move was not played), shares and points
+# are never negative, so padded steps are told apart by this value and masked out
+MASK_VALUE = -1.0
+# Upper lengths of the series batched together, longer ones share the last bucket
+BUCKET_BOUNDARIES = (4, 8, 16, 32, 64)
+
+
+def build_model(gru_units=(128, 64, 32), dropout=0.3, learning_rate=0.001):
+    setup_tensorflow()
+    input_shape = (None, 2)
+    model = models.Sequential([
+        layers.Input(shape=input_shape),
+        # Padded steps are skipped by the GRUs and left out of the average
+        layers.Masking(mask_value=MASK_VALUE),
+    ])
+    for i, units in enumerate(gru_units):
+        model.add(layers.GRU(units, return_sequences=True))
+        if i < len(gru_units) - 1:
+            model.add(layers.Dropout(dropout))
+
+    # Dense works on the last axis, same as TimeDistributed(Dense) but also for variable-length batches
+    model.add(layers.Dense(64, activation='relu'))
+    model.add(layers.Dropout(dropout))
+
+    model.add(layers.GlobalAveragePooling1D())
+
+    model.add(layers.Dense(32, activation='relu'))
+    model.add(layers.Dropout(dropout))
+    model.add(layers.Dense(16, activation='relu'))
+    model.add(layers.Dense(8, activation='relu'))
+    model.add(layers.Dense(4, activation='relu'))
+
+    model.add(layers.Dense(1, activation='sigmoid'))
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss='mse')
+    return model
+
+
+def series_to_example(series):
+    x = np.array(series[-2::-1], dtype='float32')
+    y = np.float32(min(max(series[-1][-1], 0), 1))
+    return x, y
+
+
+def shard_boundaries(shards):
+    # _id ranges of roughly equal size, found once instead of skipping on every page
+    collection = get_collection()
+    docs_count = collection.count_documents({})
+    if docs_count == 0:
+        return [None, None]
+
+    boundaries = [None]
+    for shard in range(1, shards):
+        doc = collection.find({}, {'_id': 1}).sort('_id', 1).skip(docs_count * shard // shards).limit(1).next()
+        if doc['_id'] != boundaries[-1]:
+            boundaries.append(doc['_id'])
+    boundaries.append(None)
+    return boundaries
+
+
+def iter_shard(lower, upper, fetch_size=10_000):
+    id_range = {}
+    if lower is not None:
+        id_range['$gte'] = lower
+    if upper is not None:
+        id_range['$lt'] = upper
+    query = {'_id': id_range} if id_range else {}
+
+    cursor = get_collection().find(query, {'series': 1}).sort('_id', 1).batch_size(fetch_size)
+    for doc in cursor:
+        series = doc.get('series', [])
+        if len(series) > 1:
+            yield series_to_example(series)
+
+
+class SampleCounter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, count=1):
+        with self.lock:
+            self.value += count
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    # Adds samples_per_sec to the epoch logs, the TensorBoard callback placed after it writes them out
+    def __init__(self, counter):
+        super().__init__()
+        self.counter = counter
+        self.start_time = None
+        self.start_samples = 0
+        self.train_time = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start_time = time.perf_counter()
+        self.start_samples = self.counter.value
+        self.train_time = None
+
+    def on_test_begin(self, logs=None):
+        # Validation runs inside the epoch, keep it out of the training throughput
+        if self.start_time is not None and self.train_time is None:
+            self.train_time = time.perf_counter() - self.start_time
+
+    def on_epoch_end(self, epoch, logs=None):
+        train_time = self.train_time or time.perf_counter() - self.start_time
+        samples = self.counter.value - self.start_samples
+        if logs is not None:
+            logs['samples_per_sec'] = samples / train_time if train_time > 0 else 0
+            logs['train_seconds'] = train_time
+
+
+class TelemetryCallback(tf.keras.callbacks.Callback):
+    # Batch latencies and epoch logs of the run go to the pipeline telemetry, placed after
+    # ThroughputCallback so the epoch logs include samples_per_sec
+    def __init__(self):
+        super().__init__()
+        self.telemetry = get_telemetry()
+        self.batch_start = None
+
+    def on_train_begin(self, logs=None):
+        self.telemetry.progress(self.params.get('epochs') or 0, 'epochs')
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.telemetry.observe('batch_seconds', time.perf_counter() - self.batch_start)
+        self.telemetry.count('batches')
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.telemetry.event('epoch', epoch=epoch, **{name: float(value) for name, value in (logs or {}).items()})
+        self.telemetry.advance()
+
+
+def iter_file_shard(path):
+    for series in iter_series(path):
+        if len(series) > 1:
+            yield series_to_example(series)
+
+
+def mongo_shards(shards, fetch_size=10_000):
+    boundaries = shard_boundaries(shards)
+    return [
+        lambda lower=lower, upper=upper: iter_shard(lower, upper, fetch_size)
+        for lower, upper in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+def file_shards(directory=None):
+    return [lambda path=path: iter_file_shard(path) for path in list_shards(directory or SETTINGS['vectors_dir'])]
+
+
+def training_shards(shards=20):
+    if SETTINGS.get('training_source', 'mongo') == 'files':
+        return file_shards()
+    return mongo_shards(shards)
+
+
+def make_dataset(shard_readers, shard_ids, train_batch_size=128, shuffle_buffer=100_000,
+                 bucket_boundaries=BUCKET_BOUNDARIES, counter=None):
+    shard_ids = list(shard_ids)
+
+    def shard_generator(shard):
+        for example in shard_readers[shard]():
+            if counter is not None:
+                counter.add()
+            yield example
+
+    signature = (
+        tf.TensorSpec(shape=(None, 2), dtype=tf.float32),
+        tf.TensorSpec(shape=(), dtype=tf.float32),
+    )
+    # Shards are read and decoded concurrently, one cursor each
+    dataset = tf.data.Dataset.from_tensor_slices(shard_ids).interleave(
+        lambda shard: tf.data.Dataset.from_generator(shard_generator, args=(shard,), output_signature=signature),
+        cycle_length=len(shard_ids),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False,
+    )
+    if shuffle_buffer:
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer)
+    # Series of similar length are batched together, so little time is spent on padding
+    dataset = dataset.bucket_by_sequence_length(
+        element_length_func=lambda x, y: tf.shape(x)[0],
+        bucket_boundaries=list(bucket_boundaries),
+        bucket_batch_sizes=[train_batch_size] * (len(bucket_boundaries) + 1),
+        padding_values=(tf.constant(MASK_VALUE, dtype=tf.float32), tf.constant(0, dtype=tf.float32)),
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def split_shards(shards_count, validation_split):
+    # Every n-th _id range is held out, so validation data comes from the whole collection
+    if shards_count < 2 or not validation_split:
+        return list(range(shards_count)), []
+    step = max(2, round(1 / validation_split))
+    validation = list(range(step - 1, shards_count, step)) or [shards_count - 1]
+    train = [shard for shard in range(shards_count) if shard not in validation]
+    return train, validation
+
+
+def split_examples(shard_reader, validation_split):
+    # A single shard cannot be held out, every n-th example of it is used for validation instead
+    step = max(2, round(1 / validation_split))
+    return [
+        lambda: (example for i, example in enumerate(shard_reader()) if i % step != step - 1),
+        lambda: (example for i, example in enumerate(shard_reader()) if i % step == step - 1),
+    ]
+
+
+def default_run_name(epochs=1000, train_batch_size=128):
+    return f"R2_M3_B1_{epochs}_{train_batch_size}_" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+
+
+def learn(epochs=1000, train_batch_size=128, shards=20, validation_split=0.05, run_name=None):
+    # Passing the run_name of an interrupted run resumes it from its last finished epoch
+    model_name = run_name or default_run_name(epochs, train_batch_size)
     log_dir = (SETTINGS.get('tensorboard_log_dir', 'logs/')
                + model_name
                )
     tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1)
 
-    docs_count = collection.count_documents({})
-    batch_start = 0
-
-    model = None
     if not os.path.exists(SETTINGS['model_dir']):
         os.mkdir(SETTINGS['model_dir'])
-    while batch_start < docs_count:
-        print(f"Processing batch {batch_start} to {batch_start + batch_size}")
-        docs = collection.find({}).skip(batch_start).limit(batch_size)
-        x_train = []
-        y_train = []
-
-        for doc in docs:
-            series = doc.get('series', [])
-            if len(series) > 1:
-                x_train.append([i for i in reversed(series[:-1])])
-                y_train.append(series[-1][-1])
-
-        x_train = tf.keras.preprocessing.sequence.pad_sequences(x_train, padding='post', dtype='float32', value=[0, 0])
-        y_train = np.clip(np.array(y_train), 0, 1)
-
-        dataset = tf.data.Dataset.from_tensor_slices((x_train, y_train))
-        dataset = dataset.shuffle(buffer_size=len(x_train)).batch(train_batch_size).prefetch(tf.data.AUTOTUNE)
-        if model is None:
-            input_shape = (None, 2)
-            model = models.Sequential([
-                layers.Input(shape=input_shape),
-
-                layers.GRU(128, return_sequences=True),
-                layers.Dropout(0.3),
-
-                layers.GRU(64, return_sequences=True),
-                layers.Dropout(0.3),
-
-                layers.GRU(32, return_sequences=True),
-                layers.TimeDistributed(layers.Dense(64, activation='relu')),
-                layers.Dropout(0.3),
-
-                layers.GlobalAveragePooling1D(),
-
-                layers.Dense(32, activation='relu'),
-                layers.Dropout(0.3),
-                layers.Dense(16, activation='relu'),
-                layers.Dense(8, activation='relu'),
-                layers.Dense(4, activation='relu'),
-
-                layers.Dense(1, activation='sigmoid')
-            ])
-            model.compile(optimizer='adam', loss='mse')
-
-            model.summary()
-
-        model.fit(dataset, epochs=epochs, callbacks=[tensorboard_callback, early_stopping, reduce_lr])
-        batch_start += batch_size
-        model.save(SETTINGS['model_dir'] + f'/{model_name}_{batch_start}.keras')
+
+    shard_readers = training_shards(shards)
+    train_shards, validation_shards = split_shards(len(shard_readers), validation_split)
+    if len(shard_readers) == 1 and validation_split:
+        shard_readers = split_examples(shard_readers[0], validation_split)
+        train_shards, validation_shards = [0], [1]
+    if not validation_shards:
+        print("No validation data, early stopping and the learning rate follow the training loss")
+    counter = SampleCounter()
+    dataset = make_dataset(shard_readers, train_shards, train_batch_size, counter=counter)
+    validation_dataset = None
+    if validation_shards:
+        validation_dataset = make_dataset(shard_readers, validation_shards, train_batch_size, shuffle_buffer=0)
+
+    model = build_model()
+    model.summary()
+
+    monitor = 'val_loss' if validation_dataset is not None else 'loss'
+    # New callbacks for every run, they keep the best loss and the wait count of the run they were used in
+    early_stopping = EarlyStopping(monitor=monitor, patience=30, restore_best_weights=True)
+    reduce_lr = ReduceLROnPlateau(monitor=monitor, factor=0.1, patience=10, min_lr=1e-7)
+    # Model weights, optimizer state and the epoch number are backed up after every epoch
+    backup = BackupAndRestore(backup_dir=os.path.join(SETTINGS['model_dir'], 'backup', model_name))
+    checkpoint = ModelCheckpoint(SETTINGS['model_dir'] + f'/{model_name}.keras', monitor=monitor, save_best_only=True)
+    callbacks = [backup, ThroughputCallback(counter), TelemetryCallback(), tensorboard_callback, checkpoint, reduce_lr,
+                 early_stopping]
+
+    history = model.fit(dataset, validation_data=validation_dataset, epochs=epochs, callbacks=callbacks)
     model.save(SETTINGS['model_dir'] + '/model.keras')
+    return history
 
 
 # Load and predict
 def load_and_predict(new_data):
-    model = tf.keras.models.load_model(SETTINGS['model_dir'] + '/model.keras')
-    predictions = model.predict(new_data)
-    return predictions
+    return get_predictor().load().predict(new_data)
 
 
 # Main script
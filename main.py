@@ -1,42 +1,210 @@
+import argparse
 import shutil
 import os
+import sys
 import time
 
-from convert_moves2vector import convert_dir
-from learning import learn
+from manifest import Manifest
 from settings import SETTINGS
-from split_pgn import split_pgn
-from analyze import analyze_dir
+from telemetry import get_telemetry
+
+STAGES = ('split', 'analyze', 'convert', 'learn')
 
 
 def prepare_files():
-    # pgn_file = "Giga.pgn"
-    pgn_file = "tb_all.pgn"
+    from split_pgn import split_pgn
+
+    pgn_file = SETTINGS['pgn_file']
 
     if os.path.exists(SETTINGS['splitted_pgns_dir']):
         shutil.rmtree(SETTINGS['splitted_pgns_dir'])
     os.mkdir(SETTINGS['splitted_pgns_dir'])
-    split_pgn(pgn_file)
+    # container=True writes the games to a few indexed files instead of one file per player
+    return split_pgn(pgn_file)
+
+
+def run_split(manifest, resume, **options):
+    # Splitting is quick, an interrupted split starts over
+    games, _ = prepare_files()
+    return {'games': games}
+
+
+def run_analyze(manifest, resume, single_pass=False, incremental=False, **options):
+    from analyze import analyze_dir, analyze_pgn
+
+    if not resume and not incremental:
+        # A full rebuild, the counts and ingested offsets of earlier runs would not match the new tables
+        for directory in (SETTINGS['analyzed_games'], SETTINGS['analysis_state_dir']):
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+    if single_pass:
+        # One pass without split files, after an interruption players with saved tables are skipped.
+        # incremental=True parses only the games appended to the pgn file since the last analysis.
+        analyze_pgn(SETTINGS['pgn_file'], SETTINGS['analyzed_games'], incremental=incremental)
+        return {'single_pass': True, 'incremental': incremental}
+
+    # Split files are kept until the stage ends, analyzed ones are recorded in the journal
+    analyze_dir(SETTINGS['splitted_pgns_dir'], SETTINGS['analyzed_games'], remove_inputs=False,
+                skip=manifest.done_shards('analyze'),
+                on_done=lambda file_name: manifest.record_shards('analyze', [file_name]))
+    return {}
+
+
+def run_convert(manifest, resume, **options):
+    from convert_moves2vector import SINKS, convert_dir
+
+    # Documents of the files in the journal are already in the database or the shards,
+    # a resumed run adds the rest
+    sink = SINKS[SETTINGS.get('training_source', 'mongo')]()
+    convert_dir(SETTINGS['analyzed_games'], sink=sink, remove_inputs=False, resume=resume,
+                skip=manifest.done_shards('convert'),
+                on_flushed=lambda file_names: manifest.record_shards('convert', file_names))
+    return {}
+
+
+def run_learn(manifest, resume, epochs=1000, **options):
+    # TensorFlow is imported only right before training
+    from learning import default_run_name, learn
+
+    # The same run name resumes training from its last saved epoch
+    run_name = manifest.info('learn').get('run_name') if resume else None
+    run_name = run_name or default_run_name(epochs)
+    manifest.start('learn', run_name=run_name)
+    learn(epochs=epochs, run_name=run_name)
+    return {'run_name': run_name}
 
 
-def main():
-    print("Dzielenie pliku pgn")
-    # prepare_files()
-    print("podzielono")
-    print("analiza plików")
-    # analyze_dir(SETTINGS['splitted_pgns_dir'], SETTINGS['analyzed_games'])
-    print("przeanalizowano")
-    print("konwersja na wektory")
-    # convert_dir(SETTINGS['analyzed_games'])
-    print("skonwertowano")
-    print("uczenie")
-    learn()
-    print("nauczono")
+STAGE_RUNNERS = {
+    'split': run_split,
+    'analyze': run_analyze,
+    'convert': run_convert,
+    'learn': run_learn,
+}
+
+STAGE_MESSAGES = {
+    'split': ("Dzielenie pliku pgn", "podzielono"),
+    'analyze': ("analiza plików", "przeanalizowano"),
+    'convert': ("konwersja na wektory", "skonwertowano"),
+    'learn': ("uczenie", "nauczono"),
+}
+
+
+def main(stages=STAGES, force=(), single_pass=False, clean=False, epochs=1000, incremental=False):
+    manifest = Manifest()
+    telemetry = get_telemetry()
+    # A stage without a manifest entry starts over, and so do the stages after it
+    for stage in force:
+        reset_from(manifest, stage)
+
+    for stage in stages:
+        status = manifest.status(stage)
+        if status == 'done':
+            print(f"{stage}: wykonany wcześniej, pominięto")
+            continue
+        upstream = [previous for previous in STAGES[:STAGES.index(stage)]
+                    if not (single_pass and previous == 'split') and manifest.status(previous) != 'done']
+        if upstream:
+            print(f"{stage}: najpierw trzeba wykonać {', '.join(upstream)}")
+            return False
+
+        resume = status == 'running'
+        if not resume:
+            reset_from(manifest, stage)
+        manifest.start(stage, **({'single_pass': True} if single_pass and stage == 'analyze' else {}))
+
+        start_message, end_message = STAGE_MESSAGES[stage]
+        print(start_message + (" (wznowienie)" if resume else ""))
+        with telemetry.stage(stage):
+            info = STAGE_RUNNERS[stage](manifest, resume, single_pass=single_pass, epochs=epochs,
+                                        incremental=incremental)
+            errors = telemetry.counters.get('errors', 0)
+        if errors:
+            # The stage stays unfinished, files that failed are retried when it is resumed
+            print(f"{stage}: {errors} błędów, etap nie jest zakończony")
+            manifest.start(stage, **info)
+            return False
+        manifest.finish(stage, **info)
+        print(end_message)
+
+        if clean and stage == 'analyze' and not single_pass and os.path.exists(SETTINGS['splitted_pgns_dir']):
+            # Split files are removed only once the analysis has finished
+            shutil.rmtree(SETTINGS['splitted_pgns_dir'])
+    return True
+
+
+def reset_from(manifest, stage):
+    for later in STAGES[STAGES.index(stage):]:
+        manifest.reset(later)
+
+
+def print_status(manifest):
+    for stage in STAGES:
+        info = manifest.info(stage)
+        shards = len(manifest.done_shards(stage))
+        details = ", ".join(f"{name}={value}" for name, value in info.items()
+                            if name not in ('status', 'started', 'finished'))
+        print(f"{stage:8s} {info.get('status') or '-':8s} {shards:8d} shardów  {details}")
+
+
+def stage_list(value):
+    stages = [stage for stage in value.split(',') if stage]
+    if 'all' in stages:
+        return list(STAGES)
+    for stage in stages:
+        if stage not in STAGES:
+            raise argparse.ArgumentTypeError(f"unknown stage {stage}")
+    return stages
 
 
 if __name__ == '__main__':
-    start_time = time.time()
-    main()
-    end_time = time.time()
-    elapsed_time = end_time - start_time
-    print(f"Czas: {elapsed_time}s")
+    parser = argparse.ArgumentParser(
+        description="Processes the game database in stages, resuming after an interruption")
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help="runs the stages that are not finished")
+    run_parser.add_argument('--stages', type=stage_list, default=list(STAGES),
+                            help=f"comma separated stages, {','.join(STAGES)} by default")
+    run_parser.add_argument('--force', type=stage_list, default=[],
+                            help="stages run from scratch, together with the later ones")
+    run_parser.add_argument('--single-pass', action='store_true',
+                            help="analysis in one pass over the pgn file, without splitting it")
+    run_parser.add_argument('--incremental', action='store_true',
+                            help="with --single-pass, analyzes only the games appended to the pgn file since the "
+                                 "last analysis, e.g. --force analyze --single-pass --incremental")
+    run_parser.add_argument('--clean', action='store_true',
+                            help="removes the split files once the analysis has finished")
+    run_parser.add_argument('--epochs', type=int, default=1000)
+    run_parser.add_argument('--event-log', help="JSON lines file for the stage events")
+    run_parser.add_argument('--no-progress', action='store_true', help="no progress line")
+    run_parser.add_argument('--profile', type=stage_list, default=[],
+                            help="stages (comma separated or 'all') profiled with cProfile")
+    run_parser.add_argument('--trace-memory', type=stage_list, default=[],
+                            help="stages (comma separated or 'all') traced with tracemalloc")
+    run_parser.add_argument('--profile-dir', default='profiles')
+    subparsers.add_parser('status', help="stage status from the manifest")
+    reset_parser = subparsers.add_parser('reset', help="clears the state of stages, together with the later ones")
+    reset_parser.add_argument('stages', type=stage_list)
+    mark_parser = subparsers.add_parser('mark', help="marks stages as finished, e.g. for data from before the manifest")
+    mark_parser.add_argument('stages', type=stage_list)
+    args = parser.parse_args(sys.argv[1:] or ['run'])
+    if args.command == 'run' and args.incremental and not args.single_pass:
+        run_parser.error("--incremental needs --single-pass")
+
+    if args.command == 'status':
+        print_status(Manifest())
+    elif args.command == 'reset':
+        manifest = Manifest()
+        reset_from(manifest, min(args.stages, key=STAGES.index))
+    elif args.command == 'mark':
+        manifest = Manifest()
+        for stage in args.stages:
+            manifest.finish(stage, marked=True)
+    else:
+        get_telemetry().configure(event_log=args.event_log, progress=not args.no_progress, profile=args.profile,
+                                  trace_memory=args.trace_memory, profile_dir=args.profile_dir)
+        start_time = time.time()
+        finished = main([stage for stage in STAGES if stage in args.stages], args.force, args.single_pass,
+                        args.clean, args.epochs, args.incremental)
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        print(f"Czas: {elapsed_time}s")
+        sys.exit(0 if finished else 1)
@@ -0,0 +1,77 @@
+import json
+import os
+import time
+
+from settings import SETTINGS
+
+MANIFEST_FILE = 'manifest.json'
+JOURNAL_EXT = '.done'
+
+
+class Manifest:
+    # Completion state of the pipeline stages in manifest.json, and a journal per stage with one line
+    # for every finished shard. Journals are only appended to, a crash loses at most the line being written.
+    def __init__(self, directory=None):
+        self.directory = directory or SETTINGS['manifest_dir']
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.path = os.path.join(self.directory, MANIFEST_FILE)
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.stages = json.load(file)
+        self.journals = {}
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(self.stages, file, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    def status(self, stage):
+        return self.stages.get(stage, {}).get('status')
+
+    def info(self, stage):
+        return self.stages.get(stage, {})
+
+    def start(self, stage, **info):
+        entry = self.stages.setdefault(stage, {})
+        if entry.get('status') != 'running':
+            entry['started'] = time.time()
+        entry.update(status='running', **info)
+        self.save()
+
+    def finish(self, stage, status='done', **info):
+        self.close_journal(stage)
+        self.stages.setdefault(stage, {}).update(status=status, finished=time.time(), **info)
+        self.save()
+
+    def reset(self, stage):
+        self.close_journal(stage)
+        self.stages.pop(stage, None)
+        journal_path = self.journal_path(stage)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        self.save()
+
+    def journal_path(self, stage):
+        return os.path.join(self.directory, f"{stage}{JOURNAL_EXT}")
+
+    def done_shards(self, stage):
+        journal_path = self.journal_path(stage)
+        if not os.path.exists(journal_path):
+            return set()
+        with open(journal_path) as file:
+            # A line cut by a crash has no newline and is not counted
+            return {line[:-1] for line in file if line.endswith("\n")}
+
+    def record_shards(self, stage, shards):
+        if stage not in self.journals:
+            self.journals[stage] = open(self.journal_path(stage), 'a')
+        journal = self.journals[stage]
+        journal.writelines(f"{shard}\n" for shard in shards)
+        journal.flush()
+
+    def close_journal(self, stage):
+        journal = self.journals.pop(stage, None)
+        if journal is not None:
+            journal.close()
@@ -0,0 +1,143 @@
+import json
+
+import numpy as np
+
+NUMPY_MODEL_FILE = 'model_numpy.npz'
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-np.clip(x, -80, 80)))
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def linear(x):
+    return x
+
+
+ACTIVATIONS = {
+    'sigmoid': sigmoid,
+    'relu': relu,
+    'tanh': np.tanh,
+    'linear': linear,
+}
+
+
+def export_model(model, path):
+    # Walks a trained Keras model and saves what the NumPy forward pass needs, Dropout is a no-op at inference
+    spec = []
+    arrays = {}
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        config = layer.get_config()
+        if kind == 'TimeDistributed':
+            layer = layer.layer
+            kind = layer.__class__.__name__
+            config = layer.get_config()
+
+        if kind in ('Dropout', 'InputLayer'):
+            continue
+        if kind == 'Masking':
+            entry = {'type': 'masking', 'mask_value': float(config['mask_value'])}
+        elif kind == 'GRU':
+            if not config.get('reset_after', True) or config.get('go_backwards'):
+                raise ValueError(f"GRU layer {layer.name} is not supported")
+            entry = {
+                'type': 'gru',
+                'units': config['units'],
+                'activation': config['activation'],
+                'recurrent_activation': config['recurrent_activation'],
+                'return_sequences': config['return_sequences'],
+            }
+        elif kind == 'Dense':
+            entry = {'type': 'dense', 'activation': config['activation']}
+        elif kind == 'GlobalAveragePooling1D':
+            entry = {'type': 'global_average_pooling'}
+        else:
+            raise ValueError(f"Layer {layer.name} ({kind}) is not supported")
+
+        weights = [np.asarray(weight, dtype=np.float32) for weight in layer.get_weights()]
+        entry['weights'] = len(weights)
+        for i, weight in enumerate(weights):
+            arrays[f"layer{len(spec)}_{i}"] = weight
+        spec.append(entry)
+
+    np.savez(path, spec=np.array(json.dumps(spec)), **arrays)
+
+
+class NumpyModel:
+    # Forward pass of the exported GRU model in NumPy, so inference does not need TensorFlow
+    def __init__(self, spec, weights):
+        self.spec = spec
+        self.weights = weights
+        # Padding value of a model trained with masking, None if padded steps are fed like data
+        self.mask_value = next((entry['mask_value'] for entry in spec if entry['type'] == 'masking'), None)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            spec = json.loads(str(data['spec']))
+            weights = [[data[f"layer{i}_{j}"] for j in range(entry['weights'])] for i, entry in enumerate(spec)]
+        return cls(spec, weights)
+
+    def __call__(self, batch, training=False):
+        x = np.asarray(batch, dtype=np.float32)
+        # Same propagation as Keras: the mask of the Masking layer passes through Dense and GRU layers
+        # returning sequences, and is used up by the GRU or the pooling
+        mask = None
+        for entry, weights in zip(self.spec, self.weights):
+            if entry['type'] == 'masking':
+                mask = np.any(x != entry['mask_value'], axis=-1)
+            elif entry['type'] == 'gru':
+                x = gru(x, *weights, entry, mask)
+                if not entry['return_sequences']:
+                    mask = None
+            elif entry['type'] == 'dense':
+                x = ACTIVATIONS[entry['activation']](x @ weights[0] + weights[1])
+            elif entry['type'] == 'global_average_pooling':
+                if mask is None:
+                    x = x.mean(axis=1)
+                else:
+                    weights = mask[:, :, None].astype(np.float32)
+                    x = (x * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1)
+                mask = None
+        return x
+
+    def predict(self, batch, verbose=0):
+        return self(batch)
+
+
+def gru(x, kernel, recurrent_kernel, bias, entry, mask=None):
+    # Keras GRU with reset_after=True, gates in z, r, h order. Masked steps keep the previous state,
+    # only rows with a step left are computed, so padding costs nothing past the end of short series.
+    units = entry['units']
+    activation = ACTIVATIONS[entry['activation']]
+    recurrent_activation = ACTIVATIONS[entry['recurrent_activation']]
+    input_bias, recurrent_bias = bias
+
+    # Input projections of all timesteps at once, only the recurrent part is sequential
+    inputs = x @ kernel + input_bias
+    h = np.zeros((x.shape[0], units), dtype=np.float32)
+    outputs = np.empty((x.shape[0], x.shape[1], units), dtype=np.float32)
+    for t in range(x.shape[1]):
+        if mask is None or mask[:, t].all():
+            h = gru_step(h, inputs[:, t], recurrent_kernel, recurrent_bias, units, activation,
+                         recurrent_activation)
+        else:
+            rows = np.flatnonzero(mask[:, t])
+            if len(rows):
+                h = h.copy()
+                h[rows] = gru_step(h[rows], inputs[rows, t], recurrent_kernel, recurrent_bias, units, activation,
+                                   recurrent_activation)
+        outputs[:, t] = h
+    return outputs if entry['return_sequences'] else h
+
+
+def gru_step(h, inputs, recurrent_kernel, recurrent_bias, units, activation, recurrent_activation):
+    recurrent = h @ recurrent_kernel + recurrent_bias
+    z = recurrent_activation(inputs[:, :units] + recurrent[:, :units])
+    r = recurrent_activation(inputs[:, units:2 * units] + recurrent[:, units:2 * units])
+    hh = activation(inputs[:, 2 * units:] + r * recurrent[:, 2 * units:])
+    return z * h + (1 - z) * hh
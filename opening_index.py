@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from settings import SETTINGS
+from stats_table import TABLE_EXT, load_table
+
+ROW_DTYPE = np.dtype([
+    ('player', '<u4'),
+    ('move', 'S5'),
+    ('year', '<i2'),
+    ('avg_points', '<f8'),
+    ('share', '<f8'),
+])
+BUCKET_DTYPE = np.dtype([('position', '<u8')] + ROW_DTYPE.descr)
+
+POSITIONS_FILE = 'positions.npy'
+OFFSETS_FILE = 'offsets.npy'
+ROWS_FILE = 'rows.npy'
+PLAYERS_FILE = 'players.json'
+
+
+def build_index(analyzed_dir=None, index_dir=None, buckets=256):
+    # Two passes with bounded memory: rows of all players are first split into buckets by the top bits
+    # of the position hash, then every bucket is sorted on its own and appended to the index.
+    analyzed_dir = analyzed_dir or SETTINGS['analyzed_games']
+    index_dir = index_dir or SETTINGS['opening_index']
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    bucket_dir = os.path.join(index_dir, 'buckets')
+    os.makedirs(bucket_dir)
+
+    players = sorted(
+        os.path.splitext(file_name)[0]
+        for file_name in os.listdir(analyzed_dir)
+        if file_name.endswith(TABLE_EXT)
+    )
+    shift = np.uint64(64 - int(np.log2(buckets)))
+    bucket_files = [open(os.path.join(bucket_dir, f"{bucket:04d}.bin"), 'wb') for bucket in range(buckets)]
+    total_rows = 0
+    try:
+        for player_id, player in enumerate(players):
+            table = load_table(os.path.join(analyzed_dir, f"{player}{TABLE_EXT}"), mmap=False)
+            rows = np.empty(len(table), dtype=BUCKET_DTYPE)
+            rows['position'] = table['position']
+            rows['player'] = player_id
+            for field in ('move', 'year', 'avg_points', 'share'):
+                rows[field] = table[field]
+
+            # Player tables are sorted by position, so every bucket gets one contiguous slice
+            bucket_ids = (rows['position'] >> shift).astype(np.intp)
+            bounds = np.searchsorted(bucket_ids, np.arange(buckets + 1))
+            for bucket in np.flatnonzero(bounds[1:] > bounds[:-1]):
+                bucket_files[bucket].write(rows[bounds[bucket]:bounds[bucket + 1]].tobytes())
+            total_rows += len(rows)
+    finally:
+        for bucket_file in bucket_files:
+            bucket_file.close()
+
+    index_rows = np.lib.format.open_memmap(os.path.join(index_dir, ROWS_FILE), mode='w+', dtype=ROW_DTYPE,
+                                           shape=(total_rows,))
+    positions = []
+    offsets = [np.zeros(1, dtype=np.int64)]
+    written = 0
+    for bucket in range(buckets):
+        bucket_path = os.path.join(bucket_dir, f"{bucket:04d}.bin")
+        rows = np.fromfile(bucket_path, dtype=BUCKET_DTYPE)
+        os.remove(bucket_path)
+        if len(rows) == 0:
+            continue
+        # Stable sort keeps players in order and every player's moves and years as they were
+        rows = rows[np.argsort(rows['position'], kind='stable')]
+        starts = np.flatnonzero(np.concatenate(([True], rows['position'][1:] != rows['position'][:-1])))
+        positions.append(rows['position'][starts])
+        offsets.append(written + np.append(starts[1:], len(rows)).astype(np.int64))
+        for field in ROW_DTYPE.names:
+            index_rows[written:written + len(rows)][field] = rows[field]
+        written += len(rows)
+    index_rows.flush()
+    del index_rows
+    os.rmdir(bucket_dir)
+
+    positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.uint64)
+    np.save(os.path.join(index_dir, POSITIONS_FILE), positions)
+    np.save(os.path.join(index_dir, OFFSETS_FILE), np.concatenate(offsets))
+    with open(os.path.join(index_dir, PLAYERS_FILE), 'w') as file:
+        json.dump(players, file)
+    return len(positions), total_rows
+
+
+class OpeningIndex:
+    def __init__(self, index_dir=None):
+        index_dir = index_dir or SETTINGS['opening_index']
+        self.positions = np.load(os.path.join(index_dir, POSITIONS_FILE), mmap_mode='r')
+        self.offsets = np.load(os.path.join(index_dir, OFFSETS_FILE), mmap_mode='r')
+        self.rows = np.load(os.path.join(index_dir, ROWS_FILE), mmap_mode='r')
+        with open(os.path.join(index_dir, PLAYERS_FILE)) as file:
+            self.players = json.load(file)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def find(self, position):
+        i = np.searchsorted(self.positions, np.uint64(position))
+        if i == len(self.positions) or self.positions[i] != np.uint64(position):
+            return self.rows[0:0]
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def query(self, position):
+        # player -> move -> [[year, avg_points, share], ...]
+        result = {}
+        for player, move, year, avg_points, share in self.find(position).tolist():
+            player_moves = result.setdefault(self.players[player], {})
+            player_moves.setdefault(move.decode(), []).append([year, avg_points, share])
+        return result
+
+
+def print_query(index, fen):
+    import chess
+    from analyze import position_key
+
+    start = time.perf_counter()
+    result = index.query(position_key(chess.Board(fen)))
+    elapsed = time.perf_counter() - start
+
+    for player, moves in sorted(result.items()):
+        print(player)
+        for move, years in moves.items():
+            trend = " ".join(f"{year}:{share:.2f}/{avg_points:.2f}" for year, avg_points, share in sorted(years))
+            print(f"  {move:6s} {trend}")
+    print(f"{len(result)} players, {elapsed * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Opening tree index of all analyzed players")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('--analyzed-dir', default=SETTINGS['analyzed_games'])
+    build_parser.add_argument('--index-dir', default=SETTINGS['opening_index'])
+    query_parser = subparsers.add_parser('query')
+    query_parser.add_argument('fen', nargs='?', default=None, help="position to look up, start position by default")
+    query_parser.add_argument('--index-dir', default=SETTINGS['opening_index'])
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        positions_count, rows_count = build_index(args.analyzed_dir, args.index_dir)
+        print(f"{positions_count} positions, {rows_count} rows")
+    else:
+        import chess
+
+        print_query(OpeningIndex(args.index_dir), args.fen or chess.STARTING_FEN)
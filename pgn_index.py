@@ -0,0 +1,183 @@
+import argparse
+import codecs
+import json
+import os
+import re
+import time
+
+import chess.pgn
+import numpy as np
+
+from settings import SETTINGS
+
+GAME_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('white', '<u4'),
+    ('black', '<u4'),
+    ('year', '<i2'),  # -1 for games without a year, process_pgn skips them
+    ('result', 'u1'),
+])
+
+RESULTS = ('*', '1-0', '0-1', '1/2-1/2')
+
+GAMES_FILE = 'games.npy'
+INDEX_FILE = 'index.json'
+
+INDEXED_TAGS = (b'[White ', b'[Black ', b'[Date ', b'[Result ')
+COMMENT_REGEX = re.compile(rb';|\{|\}')
+
+
+def scan_games(pgn, offset=0):
+    # Raw scan of a binary pgn handle: yields (offset, length, headers) of every game, with only the
+    # INDEXED_TAGS parsed. Moves are not parsed, comments are only followed to find where games end.
+    # Games end where chess.pgn.read_game ends them, also for headers without movetext.
+    pgn.seek(offset)
+    start = None
+    headers = None
+    state = 'none'
+    in_comment = False
+    blank_lines = 0
+    position = offset
+
+    for line in pgn:
+        line_start = position
+        position += len(line)
+        if line_start == 0:
+            line = line.removeprefix(codecs.BOM_UTF8)
+
+        # Like read_game, only a blank line ends movetext, a header line right after it is still part of it
+        if in_comment or state == 'movetext' and not line.startswith(b'%') and line.strip():
+            in_comment = skip_comments(line, in_comment)
+            continue
+
+        if line.startswith(b'['):
+            if state != 'headers':
+                if headers is not None:
+                    yield start, line_start - start, headers
+                start = line_start
+                headers = {}
+                state = 'headers'
+            blank_lines = 0
+            if line.startswith(INDEXED_TAGS):
+                tag_match = chess.pgn.TAG_REGEX.match(line.decode('utf-8', 'replace'))
+                if tag_match:
+                    headers[tag_match.group(1)] = tag_match.group(2)
+        elif line.startswith((b'%', b';')):
+            continue
+        elif not line.strip():
+            if state == 'movetext':
+                state = 'ended'
+            elif state == 'headers':
+                # read_game allows one blank line between headers, a second one ends the game
+                blank_lines += 1
+                if blank_lines == 2:
+                    state = 'ended'
+        else:
+            if state in ('none', 'ended'):
+                # Movetext without headers is a game of its own
+                if headers is not None:
+                    yield start, line_start - start, headers
+                start = line_start
+                headers = {}
+            state = 'movetext'
+            in_comment = skip_comments(line, in_comment)
+
+    if headers is not None:
+        yield start, position - start, headers
+
+
+def skip_comments(line, in_comment):
+    # Same rules as the skipping mode of chess.pgn.read_game
+    if not in_comment and b'{' not in line:
+        return False
+    for match in COMMENT_REGEX.finditer(line):
+        token = match.group(0)
+        if token == b'{':
+            in_comment = True
+        elif not in_comment and token == b';':
+            break
+        elif token == b'}':
+            in_comment = False
+    return in_comment
+
+
+def header_year(headers):
+    year = headers.get('Date', 'Unknown')[:4]
+    return int(year) if year.isdigit() else -1
+
+
+def build_pgn_index(pgn_file, index_dir=None):
+    index_dir = index_dir or SETTINGS['pgn_index']
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+
+    players = {}
+    games = []
+    with open(pgn_file, 'rb') as pgn:
+        for offset, length, headers in scan_games(pgn):
+            # Missing names default to '?' as in chess.pgn.Game
+            white = players.setdefault(headers.get('White', '?'), len(players))
+            black = players.setdefault(headers.get('Black', '?'), len(players))
+            result = headers.get('Result', '*')
+            games.append((offset, length, white, black, header_year(headers),
+                          RESULTS.index(result) if result in RESULTS else 0))
+
+    np.save(os.path.join(index_dir, GAMES_FILE), np.array(games, dtype=GAME_DTYPE))
+    stat = os.stat(pgn_file)
+    with open(os.path.join(index_dir, INDEX_FILE) + '.tmp', 'w') as file:
+        json.dump({'pgn_file': os.path.abspath(pgn_file), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                   'players': list(players)}, file)
+    os.replace(os.path.join(index_dir, INDEX_FILE) + '.tmp', os.path.join(index_dir, INDEX_FILE))
+    return len(games), len(players)
+
+
+def load_pgn_index(pgn_file, index_dir=None):
+    # The index is rebuilt if it is missing or pgn_file changed since it was built
+    index_dir = index_dir or SETTINGS['pgn_index']
+    index_path = os.path.join(index_dir, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            meta = json.load(file)
+        stat = os.stat(pgn_file)
+        if meta['pgn_file'] == os.path.abspath(pgn_file) and meta['size'] == stat.st_size \
+                and meta['mtime'] == stat.st_mtime:
+            return PgnIndex(index_dir)
+    build_pgn_index(pgn_file, index_dir)
+    return PgnIndex(index_dir)
+
+
+class PgnIndex:
+    def __init__(self, index_dir=None):
+        index_dir = index_dir or SETTINGS['pgn_index']
+        self.games = np.load(os.path.join(index_dir, GAMES_FILE), mmap_mode='r')
+        with open(os.path.join(index_dir, INDEX_FILE)) as file:
+            meta = json.load(file)
+        self.pgn_file = meta['pgn_file']
+        self.players = meta['players']
+        self.player_ids = {player: i for i, player in enumerate(self.players)}
+
+    def __len__(self):
+        return len(self.games)
+
+    def player_games(self, player, color):
+        player_id = self.player_ids.get(player)
+        if player_id is None:
+            return self.games[0:0]
+        return self.games[self.games[color] == player_id]
+
+    def read_game(self, pgn, game):
+        # Raw bytes of one game from a binary handle of the indexed file
+        pgn.seek(int(game['offset']))
+        return pgn.read(int(game['length']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Header index of a pgn file with byte offsets of every game")
+    parser.add_argument('pgn_file', nargs='?', default=SETTINGS['pgn_file'])
+    parser.add_argument('--index-dir', default=SETTINGS['pgn_index'])
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    games_count, players_count = build_pgn_index(args.pgn_file, args.index_dir)
+    print(f"{games_count} games, {players_count} players, {time.perf_counter() - start:.1f}s")
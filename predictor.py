@@ -0,0 +1,92 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from numpy_model import NUMPY_MODEL_FILE, NumpyModel
+from settings import SETTINGS
+from stats_table import reverse_series
+
+
+class Predictor:
+    def __init__(self, model_path=None, cache_size=512, numpy_model_path=None):
+        self.model_path = model_path or SETTINGS['model_dir'] + '/model.keras'
+        self.numpy_model_path = numpy_model_path or os.path.join(os.path.dirname(self.model_path), NUMPY_MODEL_FILE)
+        self.cache_size = cache_size
+        self.model = None
+        self.pad_value = 0
+        self.cache = OrderedDict()
+
+    def load(self):
+        if self.model is None:
+            # The NumPy export is used unless the Keras model was saved after it, TensorFlow is only
+            # imported when there is no up to date export
+            if os.path.exists(self.numpy_model_path) and (
+                    not os.path.exists(self.model_path)
+                    or os.path.getmtime(self.numpy_model_path) >= os.path.getmtime(self.model_path)):
+                self.model = NumpyModel.load(self.numpy_model_path)
+            else:
+                import tensorflow as tf
+
+                self.model = tf.keras.models.load_model(self.model_path)
+            self.pad_value = model_pad_value(self.model)
+        return self.model
+
+    def predict(self, series_list):
+        # Series of one position differ in length, pad them the same way as in learn()
+        return self.predict_batch(*pad_series(series_list))
+
+    def predict_batch(self, batch, lengths):
+        # Chronological series padded at the end (stats_table.series_batch), fed most recent year first
+        # as in training. A direct call skips predict()'s per-call setup and retracing for every new
+        # padded length.
+        model = self.load()
+        return np.asarray(model(reverse_series(batch, lengths, self.pad_value), training=False), dtype='float32')[:, 0]
+
+    def predict_moves(self, key, moves, batch, lengths):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        results = []
+        if moves:
+            predictions = self.predict_batch(batch, lengths)
+            results = [(move, float(value)) for move, value in zip(moves, predictions)]
+
+        self.cache[key] = results
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return results
+
+    def clear_cache(self):
+        self.cache.clear()
+
+
+_predictor = None
+
+
+def get_predictor():
+    global _predictor
+    if _predictor is None:
+        _predictor = Predictor()
+    return _predictor
+
+
+def model_pad_value(model):
+    # Models trained with a Masking layer are padded with its mask value, older ones with zeros
+    if isinstance(model, NumpyModel):
+        return model.mask_value or 0
+    for layer in model.layers:
+        if layer.__class__.__name__ == 'Masking':
+            return float(layer.get_config()['mask_value'])
+    return 0
+
+
+def pad_series(series_list):
+    # Same batch as pad_sequences(padding='post', value=0) without importing TensorFlow, and the lengths
+    series_list = [np.asarray(series, dtype='float32') for series in series_list]
+    lengths = np.array([len(series) for series in series_list])
+    batch = np.zeros((len(series_list), lengths.max(), series_list[0].shape[-1]), dtype='float32')
+    for i, series in enumerate(series_list):
+        batch[i, :len(series)] = series
+    return batch, lengths
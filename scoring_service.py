@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+from settings import SETTINGS
+from stats_table import TABLE_EXT, load_table, position_series
+
+
+class Batcher:
+    # Collects series of concurrent requests and scores them together, a batch is run once it has
+    # max_batch_size series or the oldest waiting request has waited max_delay seconds
+    def __init__(self, predictor, max_batch_size=256, max_delay=0.005):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.batch_sizes = deque(maxlen=10_000)
+        self.batch_latencies = deque(maxlen=10_000)
+
+    async def score(self, series_list):
+        if not series_list:
+            return []
+        check_series(series_list)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((series_list, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            size = len(items[0][0])
+            deadline = loop.time() + self.max_delay
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                size += len(item[0])
+
+            series = [one for series_list, _ in items for one in series_list]
+            start = time.perf_counter()
+            try:
+                # The forward pass blocks, keep the event loop accepting requests meanwhile
+                predictions = await loop.run_in_executor(None, self.predictor.predict, series)
+            except Exception as e:
+                if len(items) == 1:
+                    if not items[0][1].done():
+                        items[0][1].set_exception(e)
+                    continue
+                # Retried one request at a time, so only the request that breaks the batch gets the error
+                for item in items:
+                    try:
+                        self.resolve([item], await loop.run_in_executor(None, self.predictor.predict, item[0]))
+                    except Exception as e:
+                        if not item[1].done():
+                            item[1].set_exception(e)
+                continue
+            self.batch_latencies.append(time.perf_counter() - start)
+            self.batch_sizes.append(len(series))
+            self.resolve(items, predictions)
+
+    def resolve(self, items, predictions):
+        offset = 0
+        for series_list, future in items:
+            if not future.done():
+                future.set_result([float(value) for value in predictions[offset:offset + len(series_list)]])
+            offset += len(series_list)
+
+
+def check_series(series_list):
+    # Checked before a request joins a batch, a bad series would fail the forward pass of everyone in it
+    if not isinstance(series_list, list):
+        raise ValueError("series must be a list of series")
+    for i, series in enumerate(series_list):
+        try:
+            values = np.asarray(series, dtype='float32')
+        except (TypeError, ValueError):
+            values = None
+        if values is None or values.ndim != 2 or len(values) == 0 or values.shape[1] != 2:
+            raise ValueError(f"series {i} is not a non-empty list of [x, y] pairs")
+
+
+class ScoringService:
+    def __init__(self, predictor, analyzed_dir=None, max_batch_size=256, max_delay=0.005):
+        self.batcher = Batcher(predictor, max_batch_size, max_delay)
+        self.analyzed_dir = analyzed_dir or SETTINGS['analyzed_games']
+        self.tables = {}
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.series = 0
+        self.latencies = deque(maxlen=10_000)
+
+    def player_table(self, player, color):
+        from split_pgn import clean_player_name
+
+        # Named like the files of split_pgn, which also keeps path separators out of the path
+        if color not in ('white', 'black'):
+            raise ValueError(f"color must be white or black, not {color}")
+        key = f"{clean_player_name(player)}_{color}"
+        if key not in self.tables:
+            path = os.path.join(self.analyzed_dir, f"{key}{TABLE_EXT}")
+            self.tables[key] = load_table(path) if os.path.exists(path) else None
+        return self.tables[key]
+
+    async def handle_score(self, request):
+        # {"series": [series, ...]} or {"player": ..., "color": ..., "fen": ...}
+        # Series are counted once scored, rejected requests do not add to series_per_sec
+        if 'series' in request:
+            predictions = await self.batcher.score(request['series'])
+            self.series += len(predictions)
+            return {'predictions': predictions}
+
+        import chess
+        from analyze import position_key
+
+        table = self.player_table(request['player'], request['color'])
+        if table is None:
+            raise KeyError(f"no analyzed games of {request['player']} ({request['color']})")
+        moves, batch, lengths, _, _ = position_series(table, position_key(chess.Board(request['fen'])))
+        predictions = await self.batcher.score([series[:length] for series, length in zip(batch, lengths)])
+        self.series += len(predictions)
+        return {'predictions': dict(zip(moves, predictions))}
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        batch_latencies = np.array(self.batcher.batch_latencies) * 1000 if self.batcher.batch_latencies \
+            else np.zeros(1)
+        elapsed = time.perf_counter() - self.started
+        return {
+            'requests': self.requests,
+            'series': self.series,
+            'requests_per_sec': self.requests / elapsed,
+            'series_per_sec': self.series / elapsed,
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
+            'batch_latency_p50_ms': float(np.percentile(batch_latencies, 50)),
+            'batch_latency_p99_ms': float(np.percentile(batch_latencies, 99)),
+            'mean_batch_size': float(np.mean(self.batcher.batch_sizes)) if self.batcher.batch_sizes else 0,
+        }
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                start = time.perf_counter()
+                status, response = await self.route(method, path, body)
+                if method == 'POST' and status == 200:
+                    self.latencies.append(time.perf_counter() - start)
+
+                payload = json.dumps(response).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics()
+        if method == 'POST' and path == '/score':
+            try:
+                request = json.loads(body)
+                self.requests += 1
+                return 200, await self.handle_score(request)
+            except Exception as e:
+                return 400, {'error': str(e)}
+        return 404, {'error': f"{method} {path} not found"}
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Scoring service on http://{host}:{port} (POST /score, GET /metrics)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-delay-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    from predictor import get_predictor
+
+    predictor = get_predictor()
+    predictor.load()
+    service = ScoringService(predictor, max_batch_size=args.max_batch_size, max_delay=args.max_delay_ms / 1000)
+    asyncio.run(service.serve(args.host, args.port))
@@ -1,17 +1,28 @@
 SETTINGS = {
+    'pgn_file': 'tb_all.pgn',  # Giga.pgn
+    'pgn_index': 'pgn_index',
     'splitted_pgns_dir': 'splitted_pgns2',
     'ignored_players': ['?', '*', 'N, N', 'N, N.'],
     'analyzed_games': 'analyzed_games',
+    'analysis_state_dir': 'analysis_state',
+    'opening_index': 'opening_index',
+    'manifest_dir': 'pipeline_state',
     'mongo': {
         'host': "localhost",
         'port': 27017,
         'database': 'ai_data_set',
         'collection': 'ai_data_set2',
     },
+    'vectors_dir': 'vectors',
+    'training_source': 'mongo',  # or 'files', shards written by convert_dir with FileSink
     'model_dir': 'saved_model',
+    'sweep_dir': 'sweep',
     'API': {
         'search_player': 'https://api.bazaszachowa.smallhost.pl/search_player/',  # /name
         'search_games': 'https://api.bazaszachowa.smallhost.pl/search_player_opening_game/',  # /name/color
+        'cache_dir': 'api_cache',
+        'cache_ttl': 24 * 3600,  # seconds
+        'timeout': 30,
     },
     'tensorboard_log_dir': 'logs/'
 }
@@ -1,7 +1,13 @@
 import re
-import chess.pgn
+import json
+import zlib
+from collections import OrderedDict
+
+import numpy as np
 from unidecode import unidecode
+from pgn_index import load_pgn_index
 from settings import SETTINGS
+from telemetry import get_telemetry
 import os
 
 
@@ -9,45 +15,158 @@ def clean_player_name(name):
     return unidecode(re.sub(r'[\\|/]', '_', name))
 
 
-def split_pgn(pgn_file):
+def split_pgn(pgn_file, index_dir=None, container=False, max_open=256):
+    # Games are routed by the header index and copied as raw bytes, moves are never parsed.
+    # Undated games are left out, process_pgn drops them anyway.
+    # Returns the number of routed games and how many files were opened.
     splitted_dir = SETTINGS['splitted_pgns_dir']
     ignored_players = set(SETTINGS['ignored_players'])
-    file_handles = {}
     game_count = 0
-    max_games_before_closing = 10_000
-
-    def get_file_handle(player, color):
-        file_key = f"{player}_{color}"
-        if file_key not in file_handles:
-            file_path = os.path.join(splitted_dir, f"{file_key}.pgn")
-            file_handles[file_key] = open(file_path, 'a')
-        return file_handles[file_key]
 
-    def close_all_files():
-        for file in file_handles.values():
-            file.close()
-        file_handles.clear()
+    index = load_pgn_index(pgn_file, index_dir)
+    player_names = [clean_player_name(name) for name in index.players]
+    writer = ContainerWriter(splitted_dir) if container else WriterPool(splitted_dir, max_open)
+    telemetry = get_telemetry()
+    telemetry.progress(len(index), 'games')
 
     try:
-        with open(pgn_file, 'r') as pgn:
-            while (game := chess.pgn.read_game(pgn)):
+        with open(pgn_file, 'rb') as pgn:
+            for i, (offset, length, white_id, black_id, year, _) in enumerate(index.games.tolist()):
+                if i % 10_000 == 0:
+                    telemetry.advance(done=i)
+                if year < 0:
+                    continue
                 game_count += 1
 
-                white = clean_player_name(game.headers.get('White'))
-                black = clean_player_name(game.headers.get('Black'))
+                white = player_names[white_id]
+                black = player_names[black_id]
+                if white in ignored_players and black in ignored_players:
+                    continue
 
-                pgn_export = game.accept(chess.pgn.StringExporter(headers=True))
+                pgn.seek(offset)
+                pgn_export = pgn.read(length).rstrip() + b"\n\n"
 
                 if white not in ignored_players:
-                    file = get_file_handle(white, 'white')
-                    file.write(pgn_export + "\n\n")
+                    writer.write(f"{white}_white", pgn_export)
 
                 if black not in ignored_players:
-                    file = get_file_handle(black, 'black')
-                    file.write(pgn_export + "\n\n")
-
-                if game_count % max_games_before_closing == 0:
-                    close_all_files()
+                    writer.write(f"{black}_black", pgn_export)
 
     finally:
-        close_all_files()
+        writer.close()
+    telemetry.advance(done=len(index))
+    telemetry.count('games', game_count)
+    telemetry.count('file_opens', writer.opens)
+    return game_count, writer.opens
+
+
+class WriterPool:
+    # Append handles of the per-player files, at most max_open of them open at once. Writes go through
+    # a buffer of every handle, the least recently written handle is closed first, which flushes it.
+    def __init__(self, directory, max_open=256, buffer_size=1 << 16):
+        self.directory = directory
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.handles = OrderedDict()
+        self.opens = 0
+
+    def write(self, file_key, data):
+        handle = self.handles.get(file_key)
+        if handle is None:
+            if len(self.handles) >= self.max_open:
+                _, oldest = self.handles.popitem(last=False)
+                oldest.close()
+            handle = open(os.path.join(self.directory, f"{file_key}.pgn"), 'ab', buffering=self.buffer_size)
+            self.handles[file_key] = handle
+            self.opens += 1
+        else:
+            self.handles.move_to_end(file_key)
+        handle.write(data)
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+
+EXTENT_DTYPE = np.dtype([
+    ('key', '<u4'),
+    ('shard', '<u2'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+])
+
+CONTAINER_SHARD = 'games_{:03d}.pgn'
+CONTAINER_KEYS = 'keys.json'
+CONTAINER_EXTENTS = 'extents.npy'
+
+
+class ContainerWriter:
+    # Games of all players in a few shard files instead of one file per player and color, every
+    # file key always goes to the same shard. The index lists the byte ranges of every key.
+    # An existing container in the directory is replaced.
+    def __init__(self, directory, shards=16, buffer_size=1 << 20, extents_batch=100_000):
+        self.directory = directory
+        self.files = [open(os.path.join(directory, CONTAINER_SHARD.format(shard)), 'wb', buffering=buffer_size)
+                      for shard in range(shards)]
+        self.opens = shards
+        self.keys = {}
+        self.extents = []
+        self.extents_batch = extents_batch
+        self.extents_file = open(os.path.join(directory, CONTAINER_EXTENTS + '.tmp'), 'wb')
+
+    def write(self, file_key, data):
+        key = self.keys.get(file_key)
+        if key is None:
+            key = self.keys[file_key] = len(self.keys)
+        shard = zlib.crc32(file_key.encode()) % len(self.files)
+        file = self.files[shard]
+        self.extents.append((key, shard, file.tell(), len(data)))
+        file.write(data)
+        if len(self.extents) >= self.extents_batch:
+            self.flush_extents()
+
+    def flush_extents(self):
+        self.extents_file.write(np.array(self.extents, dtype=EXTENT_DTYPE).tobytes())
+        self.extents = []
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        self.flush_extents()
+        self.extents_file.close()
+
+        # Extents of one key together, in the order they were written
+        extents_path = os.path.join(self.directory, CONTAINER_EXTENTS)
+        extents = np.fromfile(extents_path + '.tmp', dtype=EXTENT_DTYPE)
+        np.save(extents_path, extents[np.argsort(extents['key'], kind='stable')])
+        os.remove(extents_path + '.tmp')
+        with open(os.path.join(self.directory, CONTAINER_KEYS), 'w') as file:
+            json.dump(list(self.keys), file)
+
+
+def is_container(directory):
+    return os.path.exists(os.path.join(directory, CONTAINER_KEYS))
+
+
+class PgnContainer:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, CONTAINER_KEYS)) as file:
+            self.keys = json.load(file)
+        self.key_ids = {key: i for i, key in enumerate(self.keys)}
+        self.extents = np.load(os.path.join(directory, CONTAINER_EXTENTS), mmap_mode='r')
+        self.bounds = np.searchsorted(self.extents['key'], np.arange(len(self.keys) + 1))
+
+    def read(self, file_key):
+        # All games of a file key, as one split pgn file would hold them
+        key = self.key_ids[file_key]
+        extents = self.extents[self.bounds[key]:self.bounds[key + 1]]
+        if len(extents) == 0:
+            return b''
+        with open(os.path.join(self.directory, CONTAINER_SHARD.format(int(extents['shard'][0]))), 'rb') as file:
+            chunks = []
+            for offset, length in zip(extents['offset'].tolist(), extents['length'].tolist()):
+                file.seek(offset)
+                chunks.append(file.read(length))
+        return b''.join(chunks)
@@ -0,0 +1,127 @@
+import bisect
+import os
+
+import numpy as np
+
+STATS_DTYPE = np.dtype([
+    ('position', '<u8'),
+    ('move', 'S5'),
+    ('year', '<i2'),
+    ('avg_points', '<f8'),
+    ('share', '<f8'),
+])
+
+TABLE_EXT = '.npy'
+
+
+def to_table(results):
+    # results: position -> move -> [[year, avg_points, share], ...], as returned by calculate_percentage_and_points
+    rows = [
+        (position, move.encode(), year, avg_points, share)
+        for position, moves in results.items()
+        for move, year_rows in moves.items()
+        for year, avg_points, share in year_rows
+    ]
+    table = np.array(rows, dtype=STATS_DTYPE)
+    # Stable sort keeps the move and year order of every position
+    return table[np.argsort(table['position'], kind='stable')]
+
+
+def save_table(table, path):
+    # Written under a temporary name and renamed, a table that exists is complete
+    with open(path + '.tmp', 'wb') as file:
+        np.save(file, table, allow_pickle=False)
+    os.replace(path + '.tmp', path)
+
+
+def load_table(path, mmap=True):
+    return np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+
+def find_position(table, position):
+    # Bisects the field view element by element, np.searchsorted would first copy the strided column,
+    # the whole file of a memmapped table
+    positions = table['position']
+    position = np.uint64(position)
+    start = bisect.bisect_left(positions, position)
+    end = bisect.bisect_right(positions, position, lo=start)
+    return table[start:end]
+
+
+def rows_to_moves(rows):
+    moves = {}
+    for move, year, avg_points, share in zip(rows['move'], rows['year'], rows['avg_points'], rows['share']):
+        moves.setdefault(move.decode(), []).append([int(year), float(avg_points), float(share)])
+    return moves
+
+
+def position_moves(table, position):
+    return rows_to_moves(find_position(table, position))
+
+
+def iter_positions(table):
+    for position, rows in iter_position_rows(table):
+        yield position, rows_to_moves(rows)
+
+
+def iter_position_rows(table):
+    if len(table) == 0:
+        return
+    positions = np.asarray(table['position'])
+    bounds = np.flatnonzero(positions[1:] != positions[:-1]) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(table)]))
+    for start, end in zip(starts, ends):
+        yield int(positions[start]), table[start:end]
+
+
+def series_batch(rows, max_span=None):
+    # Time series of every move in the rows of one position: [avg_points, share] of every year from the
+    # first year the move was played to the last year any move was, years it was not played are zeros.
+    # Moves played over more than max_span years are left out. Returns the moves (in order of first
+    # appearance), the series as one batch padded with zeros at the end, their lengths, first years
+    # and the last year.
+    move_codes, first_rows, move_ids = np.unique(rows['move'], return_index=True, return_inverse=True)
+    move_ids = move_ids.reshape(-1)
+    years = np.asarray(rows['year'], dtype=np.int64)
+    first_years = np.full(len(move_codes), np.iinfo(np.int64).max)
+    last_years = np.full(len(move_codes), np.iinfo(np.int64).min)
+    np.minimum.at(first_years, move_ids, years)
+    np.maximum.at(last_years, move_ids, years)
+
+    kept = np.argsort(first_rows)
+    if max_span is not None:
+        kept = kept[last_years[kept] - first_years[kept] <= max_span]
+    if len(kept) == 0:
+        return [], np.zeros((0, 0, 2), dtype=np.float32), np.zeros(0, dtype=np.int64), \
+            np.zeros(0, dtype=np.int64), 0
+
+    # Rank of every move in the batch, -1 for moves left out
+    ranks = np.full(len(move_codes), -1)
+    ranks[kept] = np.arange(len(kept))
+    row_ranks = ranks[move_ids]
+    used = row_ranks >= 0
+
+    last_year = int(last_years[kept].max())
+    first_years = first_years[kept]
+    lengths = last_year - first_years + 1
+    batch = np.zeros((len(kept), lengths.max(), 2), dtype=np.float32)
+    row_ranks = row_ranks[used]
+    steps = years[used] - first_years[row_ranks]
+    batch[row_ranks, steps, 0] = rows['avg_points'][used]
+    batch[row_ranks, steps, 1] = rows['share'][used]
+    return [move.decode() for move in move_codes[kept].tolist()], batch, lengths, first_years, last_year
+
+
+def position_series(table, position):
+    return series_batch(find_position(table, position))
+
+
+def reverse_series(batch, lengths, pad_value=0):
+    # Every series in reverse, most recent year first and the padding still at the end, the order
+    # the model is trained on (learning.series_to_example)
+    steps = np.arange(batch.shape[1])
+    source = lengths[:, None] - 1 - steps
+    reversed_batch = batch[np.arange(len(batch))[:, None], np.maximum(source, 0)]
+    reversed_batch[source < 0] = pad_value
+    return reversed_batch
@@ -0,0 +1,299 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+
+import numpy as np
+
+from settings import SETTINGS
+
+SEARCH_SPACE = {
+    'gru_units': [[128, 64, 32], [64, 32], [32]],
+    'dropout': [0.1, 0.3],
+    'batch_size': [64, 128, 256],
+    'learning_rate': [0.001, 0.0003],
+}
+
+# Values of build_model and learn, used for what a space leaves out
+BASELINE = {
+    'gru_units': [[128, 64, 32]],
+    'dropout': [0.3],
+    'batch_size': [128],
+    'learning_rate': [0.001],
+}
+
+DATA_FILE = 'data_{examples}.npz'
+LEADERBOARD_FILE = 'leaderboard.json'
+LATENCY_BATCH = 64
+
+
+def candidates(space, samples=None, seed=0):
+    # Every combination of the space, or samples of them drawn at random
+    space = {**BASELINE, **space}
+    names = list(space)
+    configs = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if samples is not None and samples < len(configs):
+        configs = random.Random(seed).sample(configs, samples)
+    return configs
+
+
+def candidate_name(config):
+    return (f"G{'-'.join(str(units) for units in config['gru_units'])}_D{config['dropout']}"
+            f"_B{config['batch_size']}_LR{config['learning_rate']}")
+
+
+def cache_data(path, max_examples, shards=20):
+    # Examples of every training shard, up to max_examples in total, stored back to back as in vector
+    # shards. Built once and shared by all candidates and sweeps.
+    from learning import training_shards
+
+    shard_readers = training_shards(shards)
+    per_shard = max(1, max_examples // len(shard_readers))
+    xs, ys = [], []
+    for reader in shard_readers:
+        for x, y in itertools.islice(reader(), per_shard):
+            xs.append(x)
+            ys.append(y)
+
+    offsets = np.zeros(len(xs) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in xs], out=offsets[1:])
+    values = np.concatenate(xs) if xs else np.zeros((0, 2), dtype=np.float32)
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, values=values, offsets=offsets, y=np.array(ys, dtype=np.float32))
+    os.replace(path + '.tmp', path)
+    return len(xs)
+
+
+def load_data(path):
+    with np.load(path) as data:
+        return data['values'], data['offsets'], data['y']
+
+
+def split_examples(count, validation_split=0.1, seed=0):
+    ids = np.random.default_rng(seed).permutation(count)
+    validation_count = max(1, int(count * validation_split))
+    return ids[validation_count:], ids[:validation_count]
+
+
+def padded_batches(data, ids, batch_size, seed=0):
+    # Same batches as make_dataset: series of one length bucket together, padded with MASK_VALUE to the
+    # longest one in the batch, batches in random order. step_functions takes any length without tracing again.
+    from learning import BUCKET_BOUNDARIES, MASK_VALUE
+
+    values, offsets, y = data
+    rng = np.random.default_rng(seed)
+    lengths = offsets[1:] - offsets[:-1]
+    buckets = np.searchsorted(BUCKET_BOUNDARIES, lengths[ids], side='right')
+    batches = []
+    for bucket in np.unique(buckets):
+        bucket_ids = rng.permutation(ids[buckets == bucket])
+        for start in range(0, len(bucket_ids), batch_size):
+            batch_ids = bucket_ids[start:start + batch_size]
+            x = np.full((len(batch_ids), lengths[batch_ids].max(), 2), MASK_VALUE, dtype=np.float32)
+            for row, i in enumerate(batch_ids):
+                x[row, :lengths[i]] = values[offsets[i]:offsets[i + 1]]
+            batches.append((x, y[batch_ids]))
+    rng.shuffle(batches)
+    return batches
+
+
+def limit_threads(threads):
+    # Runs in every worker before TensorFlow is imported, so the candidates do not fight over the cores
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def step_functions(model):
+    # Training and validation steps traced once for any batch size and series length, train_on_batch
+    # traces its step again for every new shape it is given
+    import tensorflow as tf
+
+    signature = (tf.TensorSpec((None, None, 2), tf.float32), tf.TensorSpec((None,), tf.float32))
+    model.optimizer.build(model.trainable_weights)
+
+    @tf.function(input_signature=signature)
+    def train_step(x, y):
+        with tf.GradientTape() as tape:
+            loss = model.compute_loss(x, y, model(x, training=True))
+        model.optimizer.apply_gradients(zip(tape.gradient(loss, model.trainable_weights), model.trainable_weights))
+        return loss
+
+    @tf.function(input_signature=signature)
+    def test_step(x, y):
+        return model.compute_loss(x, y, model(x, training=False), training=False)
+
+    return train_step, test_step
+
+
+_data = {}
+
+
+def train_candidate(config, data_path, sweep_dir, epochs_done, epochs, seed=0):
+    # Trains one candidate up to epochs, continuing from the model saved at the end of its previous rung
+    import tensorflow as tf
+    from learning import build_model
+    from numpy_model import export_model
+
+    if data_path not in _data:
+        _data[data_path] = load_data(data_path)
+    data = _data[data_path]
+    train_ids, validation_ids = split_examples(len(data[2]), seed=seed)
+
+    name = candidate_name(config)
+    model_path = os.path.join(sweep_dir, f"{name}.keras")
+    if epochs_done and os.path.exists(model_path):
+        model = tf.keras.models.load_model(model_path)
+    else:
+        model = build_model(config['gru_units'], config['dropout'], config['learning_rate'])
+
+    train_step, test_step = step_functions(model)
+    start = time.perf_counter()
+    samples = 0
+    for epoch in range(epochs_done, epochs):
+        for x, y in padded_batches(data, train_ids, config['batch_size'], seed=seed + epoch):
+            train_step(x, y)
+            samples += len(x)
+    train_seconds = time.perf_counter() - start
+
+    validation = padded_batches(data, validation_ids, 256, seed=seed)
+    val_loss = sum(float(test_step(x, y)) * len(x) for x, y in validation) / len(validation_ids)
+    model.save(model_path)
+    numpy_path = os.path.join(sweep_dir, f"{name}.npz")
+    export_model(model, numpy_path)
+
+    return {
+        'name': name,
+        'config': config,
+        'epochs': epochs,
+        'val_loss': val_loss,
+        'params': model.count_params(),
+        'train_samples_per_sec': samples / train_seconds if train_seconds > 0 else 0,
+        'numpy_model': numpy_path,
+    }
+
+
+def inference_latency(numpy_path, data, ids, repeat=10):
+    # Serving latency of the NumPy export (predictor.Predictor) for one batch of series, in milliseconds
+    from numpy_model import NumpyModel
+
+    numpy_model = NumpyModel.load(numpy_path)
+    batches = padded_batches(data, ids, len(ids))
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for x, _ in batches:
+            numpy_model(x)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def run_sweep(space=None, samples=None, workers=2, threads=1, max_examples=50_000, rungs=(1, 3, 9), eta=3,
+              sweep_dir=None, refresh_data=False, seed=0):
+    # Successive halving: all candidates train for rungs[0] epochs, the best 1/eta of them continue
+    # to rungs[1] epochs and so on, the rest are stopped with the loss they reached
+    sweep_dir = sweep_dir or SETTINGS['sweep_dir']
+    if not os.path.exists(sweep_dir):
+        os.makedirs(sweep_dir)
+    data_path = os.path.join(sweep_dir, DATA_FILE.format(examples=max_examples))
+    if refresh_data or not os.path.exists(data_path):
+        print(f"Caching {cache_data(data_path, max_examples)} examples in {data_path}")
+
+    configs = candidates(space or SEARCH_SPACE, samples, seed)
+    results = {}
+    kept = []
+    epochs_done = 0
+    # Spawned workers, TensorFlow does not survive a fork
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=limit_threads, initargs=(threads,)) as executor:
+        for rung, epochs in enumerate(rungs):
+            futures = {executor.submit(train_candidate, config, data_path, sweep_dir, epochs_done, epochs, seed): config
+                       for config in configs}
+            rung_results = []
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    name = candidate_name(futures[future])
+                    print(f"Error training candidate {name}: {e}")
+                    # Kept on the leaderboard with the loss of the rung it finished last
+                    if name in results:
+                        results[name]['status'] = 'failed'
+                    continue
+                result['status'] = 'running'
+                results[result['name']] = result
+                rung_results.append(result)
+                print(f"rung {rung}: {result['name']:32s} val_loss {result['val_loss']:.5f} "
+                      f"{result['train_samples_per_sec']:.0f} samples/s")
+
+            rung_results.sort(key=lambda result: result['val_loss'])
+            kept = rung_results if rung == len(rungs) - 1 else rung_results[:max(1, len(rung_results) // eta)]
+            for result in rung_results[len(kept):]:
+                result['status'] = f"stopped after {epochs} epochs"
+            configs = [result['config'] for result in kept]
+            epochs_done = epochs
+        for result in kept:
+            result['status'] = 'finished'
+
+    # Measured one model at a time after training, so the latencies are not skewed by busy workers
+    data = load_data(data_path)
+    _, validation_ids = split_examples(len(data[2]), seed=seed)
+    for result in results.values():
+        result['latency_ms'] = inference_latency(result['numpy_model'], data, validation_ids[:LATENCY_BATCH])
+
+    leaderboard = sorted(results.values(), key=lambda result: result['val_loss'])
+    with open(os.path.join(sweep_dir, LEADERBOARD_FILE), 'w') as file:
+        json.dump(leaderboard, file, indent=2)
+    print_leaderboard(leaderboard)
+    return leaderboard
+
+
+def rung_list(value):
+    rungs = [int(epochs) for epochs in value.split(',') if epochs]
+    if not rungs:
+        raise argparse.ArgumentTypeError("at least one rung is needed")
+    if any(epochs <= previous for previous, epochs in zip([0] + rungs, rungs)):
+        raise argparse.ArgumentTypeError("epochs of the rungs must be positive and increasing")
+    return rungs
+
+
+def print_leaderboard(leaderboard):
+    # * marks candidates no other one beats on both validation loss and latency
+    print(f"  {'candidate':32s} {'val_loss':>9s} {'latency ms':>10s} {'params':>8s} {'epochs':>6s}  status")
+    for result in leaderboard:
+        dominated = any(other['val_loss'] <= result['val_loss'] and other['latency_ms'] <= result['latency_ms']
+                        and other is not result for other in leaderboard)
+        print(f"{' ' if dominated else '*'} {result['name']:32s} {result['val_loss']:9.5f} "
+              f"{result['latency_ms']:10.2f} {result['params']:8d} {result['epochs']:6d}  {result['status']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep with successive halving")
+    parser.add_argument('--space', help="json file with lists of values of gru_units, dropout, batch_size and "
+                                        "learning_rate, SEARCH_SPACE by default")
+    parser.add_argument('--samples', type=int, help="random candidates of the space instead of all of them")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    parser.add_argument('--threads', type=int, default=1, help="CPU threads of every worker")
+    parser.add_argument('--max-examples', type=int, default=50_000)
+    parser.add_argument('--rungs', type=rung_list, default=[1, 3, 9],
+                        help="epochs after which the worst candidates are stopped, e.g. 1,3,9")
+    parser.add_argument('--eta', type=int, default=3, help="1/eta of the candidates continue after a rung")
+    parser.add_argument('--sweep-dir', default=SETTINGS['sweep_dir'])
+    parser.add_argument('--refresh-data', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    space = None
+    if args.space:
+        with open(args.space) as file:
+            space = json.load(file)
+    run_sweep(space, args.samples, args.workers, args.threads, args.max_examples,
+              args.rungs, args.eta, args.sweep_dir, args.refresh_data, args.seed)
@@ -0,0 +1,83 @@
+import random
+import zlib
+from itertools import accumulate
+
+import chess
+
+RESULTS = ["1-0", "1/2-1/2", "0-1"]
+RESULT_WEIGHTS = [0.37, 0.33, 0.30]
+
+
+def random_line(rng, max_plies):
+    board = chess.Board()
+    tokens = []
+    for ply in range(rng.randint(10, max_plies)):
+        # Stable per-position ranking, so lines share the same popular openings
+        board_fen = board.board_fen()
+        moves = sorted(board.legal_moves, key=lambda m: zlib.crc32(f"{board_fen} {m.uci()}".encode()))
+        if not moves:
+            break
+        # Openings concentrate on a few main lines and spread out later in the game
+        move = moves[min(int(rng.expovariate(3.0 / (1 + ply // 4))), len(moves) - 1)]
+        if ply % 2 == 0:
+            tokens.append(f"{ply // 2 + 1}.")
+        tokens.append(board.san(move))
+        board.push(move)
+    return " ".join(tokens)
+
+
+def generate_games(games, players=None, seed=0, first_year=1970, last_year=2024, max_plies=60, lines=None):
+    rng = random.Random(seed)
+    if players is None:
+        players = max(2, games // 20)
+    names = [f"Player{i:06d}, S" for i in range(players)]
+    # Cumulative weights, rng.choices would sum plain weights again on every call
+    # A few very active players and a long tail, as in real databases
+    activity = list(accumulate(1 / (i + 1) ** 0.8 for i in range(players)))
+    # More games in recent years, every player active for a part of the period only
+    years = list(range(first_year, last_year + 1))
+    year_weights = list(accumulate(1 + (year - first_year) ** 1.5 for year in years))
+    careers = []
+    for _ in range(players):
+        start = rng.choices(years, cum_weights=year_weights)[0]
+        careers.append((start, min(last_year, start + rng.randint(3, 30))))
+    # Move generation dominates, so games are drawn from a pool of lines with popular ones repeating
+    if lines is None:
+        lines = max(50, min(games // 10, 2000))
+    line_pool = [random_line(rng, max_plies) for _ in range(lines)]
+    line_weights = list(accumulate(1 / (i + 1) for i in range(lines)))
+    result_weights = list(accumulate(RESULT_WEIGHTS))
+
+    for game_number in range(games):
+        white_id, black_id = rng.choices(range(players), cum_weights=activity, k=2)
+        white, black = names[white_id], names[black_id]
+        if rng.random() < 0.02:
+            black = "?"
+        if rng.random() < 0.05:
+            date = "????.??.??"
+        else:
+            date = f"{rng.randint(*careers[white_id])}.{rng.randint(1, 12):02d}.{rng.randint(1, 28):02d}"
+        result = rng.choices(RESULTS, cum_weights=result_weights)[0]
+        line = rng.choices(line_pool, cum_weights=line_weights)[0]
+
+        yield (f'[Event "Synthetic {game_number}"]\n'
+               f'[Site "?"]\n'
+               f'[Date "{date}"]\n'
+               f'[Round "?"]\n'
+               f'[White "{white}"]\n'
+               f'[Black "{black}"]\n'
+               f'[Result "{result}"]\n\n'
+               f'{line} {result}\n\n')
+
+
+def generate_pgn(path, games, players=None, seed=0, **kwargs):
+    with open(path, 'w') as out:
+        for pgn in generate_games(games, players, seed, **kwargs):
+            out.write(pgn)
+    return games
+
+
+if __name__ == '__main__':
+    import sys
+
+    generate_pgn(sys.argv[1], int(sys.argv[2]), seed=int(sys.argv[3]) if len(sys.argv) > 3 else 0)
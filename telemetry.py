@@ -0,0 +1,273 @@
+import heapq
+import json
+import os
+import random
+import sys
+import time
+from contextlib import contextmanager
+
+SLOWEST_KEPT = 5
+# Values kept for the percentiles of a histogram, e.g. the batch times of a long training
+SAMPLE_SIZE = 10_000
+
+
+class Histogram:
+    # One measurement in a stage: exact count, sum and max, percentiles from a uniform sample of at most
+    # SAMPLE_SIZE values (reservoir sampling), and the labels of the largest values to spot stragglers
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.max = None
+        self.sample = []
+        self.random = random.Random(0)
+        self.largest = []
+
+    def add(self, value, label=None):
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.sample) < SAMPLE_SIZE:
+            self.sample.append(value)
+        else:
+            index = self.random.randrange(self.count)
+            if index < SAMPLE_SIZE:
+                self.sample[index] = value
+        if label is not None:
+            if len(self.largest) < SLOWEST_KEPT:
+                heapq.heappush(self.largest, (value, label))
+            elif value > self.largest[0][0]:
+                heapq.heapreplace(self.largest, (value, label))
+
+    def summary(self):
+        values = sorted(self.sample)
+        summary = {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count,
+            'p50': values[len(values) // 2],
+            'p90': values[int(len(values) * 0.9)],
+            'p99': values[int(len(values) * 0.99)],
+            'max': self.max,
+        }
+        if self.largest:
+            summary['largest'] = [[label, value] for value, label in sorted(self.largest, reverse=True)]
+        return summary
+
+
+class Progress:
+    # One status line with rate and ETA, redrawn in place on a terminal and printed every
+    # log_interval seconds otherwise (e.g. output redirected to a file). Counters named in rates are
+    # shown with their rate too.
+    def __init__(self, stage, total, unit, rates=(), stream=sys.stderr, interval=0.5, log_interval=30):
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.rates = rates
+        self.stream = stream
+        self.tty = stream.isatty()
+        self.interval = interval if self.tty else log_interval
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self.last_draw = 0
+
+    def update(self, done, counters, force=False):
+        self.done = done
+        now = time.perf_counter()
+        if not force and now - self.last_draw < self.interval:
+            return
+        self.last_draw = now
+        elapsed = now - self.start_time
+        rate = done / elapsed if elapsed > 0 else 0
+        if self.unit == 'bytes':
+            line = f"{self.stage}: {done / 2 ** 20:.0f}/{self.total / 2 ** 20:.0f} MB, {rate / 2 ** 20:.1f} MB/s"
+        else:
+            line = f"{self.stage}: {done}/{self.total} {self.unit}, {rate:.0f} {self.unit}/s"
+        if rate > 0 and done < self.total:
+            line += f", ETA {format_seconds((self.total - done) / rate)}"
+        for name, value in counters.items():
+            line += f", {name} {value}"
+            if name in self.rates and elapsed > 0:
+                line += f" ({value / elapsed:.0f}/s)"
+        if self.tty:
+            self.stream.write("\r\033[K" + line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def clear(self):
+        if self.tty and self.last_draw:
+            self.stream.write("\r\033[K")
+            self.stream.flush()
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class Telemetry:
+    # Counters, histograms and progress of the running stage, reported and reset when the stage ends.
+    # Worker processes do not share it: pool tasks send their timings back with their results and the
+    # parent records them.
+    def __init__(self):
+        self.configure()
+        self.stage_name = None
+        self.reset()
+
+    def configure(self, event_log=None, progress=True, profile=(), trace_memory=(), profile_dir='profiles'):
+        # profile and trace_memory are names of stages, or 'all'
+        self.event_log = event_log
+        self.show_progress = progress
+        self.profile = set(profile)
+        self.trace_memory = set(trace_memory)
+        self.profile_dir = profile_dir
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.rates = ()
+        self.progress_view = None
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, label=None):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].add(value, label)
+
+    @contextmanager
+    def timer(self, name, label=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, label)
+
+    def event(self, kind, **fields):
+        if self.event_log is None:
+            return
+        record = {'time': time.time(), 'stage': self.stage_name, 'event': kind, **fields}
+        with open(self.event_log, 'a') as file:
+            file.write(json.dumps(record, default=str) + "\n")
+
+    def error(self, item, message):
+        self.count('errors')
+        self.event('error', item=item, message=message)
+        if self.progress_view is not None:
+            self.progress_view.clear()
+        print(f"Error processing {item}: {message}")
+
+    def progress(self, total, unit='files', rates=()):
+        # rates: counters reported per second as well, e.g. documents of a stage counted in files
+        if self.stage_name is None:
+            # Outside a stage every call with progress is a unit of work of its own
+            self.reset()
+        self.rates = tuple(rates)
+        if self.show_progress:
+            self.progress_view = Progress(self.stage_name or 'progress', total, unit, self.rates)
+
+    def advance(self, value=1, done=None):
+        # done sets the absolute position, e.g. a byte offset, instead of adding value
+        if self.progress_view is not None:
+            self.progress_view.update(self.progress_view.done + value if done is None else done, self.counters)
+
+    def summary(self):
+        return {
+            'counters': dict(self.counters),
+            'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+        }
+
+    @contextmanager
+    def stage(self, name):
+        self.stage_name = name
+        self.reset()
+        self.event('stage_start')
+        profiler = None
+        if name in self.profile or 'all' in self.profile:
+            import cProfile
+
+            profiler = cProfile.Profile()
+        tracing = name in self.trace_memory or 'all' in self.trace_memory
+        if tracing:
+            import tracemalloc
+
+            tracemalloc.start()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        failed = None
+        try:
+            yield self
+        except BaseException as e:
+            failed = repr(e)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+            if self.progress_view is not None:
+                self.progress_view.update(self.progress_view.done, self.counters, force=True)
+                if self.progress_view.tty:
+                    self.progress_view.stream.write("\n")
+            fields = {'seconds': seconds, **self.summary()}
+            if self.rates:
+                fields['rates'] = {name: self.counters.get(name, 0) / seconds for name in self.rates}
+            if failed is not None:
+                fields['error'] = failed
+            if profiler is not None:
+                fields['profile'] = self.save_profile(name, profiler)
+            if tracing:
+                fields['memory'] = self.memory_report()
+            self.event('stage_end', **fields)
+            print_summary(name, fields)
+            self.stage_name = None
+            self.reset()
+
+    def save_profile(self, name, profiler):
+        import pstats
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}.prof")
+        profiler.dump_stats(path)
+        # Only the calling process is profiled, worker pools show up as waiting on results
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+        return path
+
+    def memory_report(self):
+        import tracemalloc
+
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        tracemalloc.stop()
+        return {
+            'current_mb': current / 2 ** 20,
+            'peak_mb': peak / 2 ** 20,
+            'top': [[str(stat.traceback), stat.size / 2 ** 20] for stat in top],
+        }
+
+
+def print_summary(name, fields):
+    line = f"{name}: {format_seconds(fields['seconds'])}"
+    rates = fields.get('rates', {})
+    line += "".join(f", {counter} {value}" + (f" ({rates[counter]:.0f}/s)" if counter in rates else "")
+                    for counter, value in fields['counters'].items())
+    print(line)
+    for histogram, summary in fields['histograms'].items():
+        print(f"  {histogram}: n={summary['count']} mean={summary['mean']:.4g} p50={summary['p50']:.4g} "
+              f"p99={summary['p99']:.4g} max={summary['max']:.4g}")
+        for label, value in summary.get('largest', [])[:3]:
+            print(f"    {value:.4g} {label}")
+    if 'memory' in fields:
+        print(f"  memory: peak {fields['memory']['peak_mb']:.1f} MB")
+        for location, size in fields['memory']['top'][:5]:
+            print(f"    {size:.1f} MB {location}")
+
+
+_telemetry = Telemetry()
+
+
+def get_telemetry():
+    return _telemetry
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+
+SHARD_EXT = '.npz'
+
+
+def write_shard(path, documents):
+    # All series of a shard are stored back to back in one array, offsets mark where each one starts
+    lengths = np.array([len(document['series']) for document in documents], dtype=np.int64)
+    offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.zeros((offsets[-1], 2), dtype=np.float32)
+    for document, start, end in zip(documents, offsets[:-1], offsets[1:]):
+        values[start:end] = document['series']
+
+    # Written under a temporary name and renamed, a shard that exists is complete
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(
+            file,
+            values=values,
+            offsets=offsets,
+            first_year=np.array([document['first_year'] for document in documents], dtype=np.int16),
+            last_year=np.array([document['last_year'] for document in documents], dtype=np.int16),
+        )
+    os.replace(path + '.tmp', path)
+
+
+def read_shard(path):
+    with np.load(path) as shard:
+        return shard['values'], shard['offsets']
+
+
+def iter_series(path):
+    values, offsets = read_shard(path)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        yield values[start:end]
+
+
+def list_shards(directory):
+    if not os.path.exists(directory):
+        return []
+    return sorted(
+        os.path.join(directory, file_name)
+        for file_name in os.listdir(directory)
+        if file_name.endswith(SHARD_EXT)
+    )